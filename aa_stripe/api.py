@@ -1,31 +1,167 @@
-import simplejson as json
 import stripe
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import status
-from rest_framework.generics import CreateAPIView, RetrieveAPIView, RetrieveUpdateAPIView
+from rest_framework.generics import (CreateAPIView, GenericAPIView, ListAPIView, ListCreateAPIView, RetrieveAPIView,
+                                     RetrieveUpdateAPIView)
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
-from aa_stripe.models import StripeCoupon, StripeCustomer, StripeWebhook
-from aa_stripe.serializers import (StripeCouponSerializer, StripeCustomerDetailsSerializer, StripeCustomerSerializer,
+from aa_stripe.cache import KEY_PREFIX, get_cache
+from aa_stripe.models import StripeCharge, StripeCoupon, StripeCustomer, StripeSubscription, StripeWebhook
+from aa_stripe.serializers import (StripeChargeSerializer, StripeCouponSerializer, StripeCouponsValidationSerializer,
+                                   StripeCouponValidationSerializer, StripeCustomerDetailsSerializer,
+                                   StripeCustomerListSerializer, StripeCustomerSerializer, StripeSubscriptionSerializer,
                                    StripeWebhookSerializer)
 from aa_stripe.settings import stripe_settings
+from aa_stripe.utils import to_dict
 
 
-class CouponDetailsAPI(RetrieveAPIView):
+class StripeCursorPagination(CursorPagination):
+    """Keyset pagination, newest objects first, served by the (user, -created, -id) indexes"""
+
+    ordering = ("-created", "-id")
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+
+class UserObjectsMixin(object):
+    """Lists objects of the request user, loading only the model fields listed in only_fields"""
+
+    pagination_class = StripeCursorPagination
+    permission_classes = (IsAuthenticated,)
+    only_fields = ()
+
+    def get_queryset(self):
+        return super(UserObjectsMixin, self).get_queryset().filter(user=self.request.user).only(*self.only_fields)
+
+
+class ConditionalRetrieveMixin(object):
+    """
+    Adds ETags derived from the updated timestamp of the object to the responses. If the If-None-Match header matches,
+    304 response is returned after a single query of the timestamp, without loading and serializing the object.
+
+    Serialized objects are cached for STRIPE_API_CACHE_TIMEOUT seconds, if the setting is set. The cache is keyed by
+    the ETag, so changes of the objects are never served from the cache.
+
+    Responses of updates (PUT and PATCH) carry the ETag of the updated object as well.
+    """
+
+    def get_etag(self, pk, updated):
+        return quote_etag("{}-{}-{}".format(self.__class__.__name__, pk, int(updated.timestamp() * 1000000)))
+
+    def get_lookup_filter(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        return {self.lookup_field: self.kwargs[lookup_url_kwarg]}
+
+    def get_current(self):
+        """Returns the primary key and the updated timestamp of the object, or None if it does not exist"""
+        return self.filter_queryset(self.get_queryset()).filter(**self.get_lookup_filter()).values_list(
+            "pk", "updated").first()
+
+    def retrieve(self, request, *args, **kwargs):
+        current = self.get_current()
+        if current is None:
+            raise Http404
+
+        etag = self.get_etag(*current)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        timeout = stripe_settings.API_CACHE_TIMEOUT
+        cache_key = "{}:response:{}".format(KEY_PREFIX, etag)
+        data = get_cache().get(cache_key) if timeout else None
+        if data is None:
+            instance = self.get_object()
+            etag = self.get_etag(instance.pk, instance.updated)  # the object could have changed in the meantime
+            cache_key = "{}:response:{}".format(KEY_PREFIX, etag)
+            data = self.get_serializer(instance).data
+            if timeout:
+                get_cache().set(cache_key, data, timeout=timeout)
+
+        response = Response(data)
+        response["ETag"] = etag
+        return response
+
+    def perform_update(self, serializer):
+        super(ConditionalRetrieveMixin, self).perform_update(serializer)
+        self.updated_object = serializer.instance
+
+    def update(self, request, *args, **kwargs):
+        response = super(ConditionalRetrieveMixin, self).update(request, *args, **kwargs)
+        response["ETag"] = self.get_etag(self.updated_object.pk, self.updated_object.updated)
+        return response
+
+
+class CouponDetailsAPI(ConditionalRetrieveMixin, RetrieveAPIView):
     queryset = StripeCoupon.objects.all()
     serializer_class = StripeCouponSerializer
     permission_classes = (IsAuthenticated,)
     lookup_field = "coupon_id"
 
+    def get_current(self):
+        coupon = StripeCoupon.get_cached_coupon(self.kwargs["coupon_id"])
+        if coupon is None:
+            return None
+        # conditional responses do not call get_object()
+        self.check_object_permissions(self.request, coupon)
+        return coupon.pk, coupon.updated
 
-class CustomersAPI(CreateAPIView):
-    queryset = StripeCustomer.objects.all()
-    serializer_class = StripeCustomerSerializer
+    def get_object(self):
+        # the coupon has been just cached by get_current()
+        coupon = StripeCoupon.get_cached_coupon(self.kwargs["coupon_id"])
+        if coupon is None:
+            raise Http404
+        self.check_object_permissions(self.request, coupon)
+        return coupon
+
+
+class CouponsValidationAPI(GenericAPIView):
+    """Validates a list of coupon ids with a single query, unknown and deleted coupons are not valid"""
+
+    queryset = StripeCoupon.objects.all()
+    serializer_class = StripeCouponsValidationSerializer
     permission_classes = (IsAuthenticated,)
 
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        coupon_ids = list(dict.fromkeys(serializer.validated_data["coupon_ids"]))  # unique, in the requested order
+
+        queryset = self.get_queryset().filter(coupon_id__in=coupon_ids).only(
+            "coupon_id", "is_deleted", "valid", "created", "redeem_by", "max_redemptions", "times_redeemed",
+            "amount_off", "percent_off", "currency", "duration", "duration_in_months",
+        )
+        # the newest coupon wins, as in the details API
+        coupons = {coupon.coupon_id: coupon for coupon in queryset.order_by("created")}
 
-class CustomerDetailsAPI(RetrieveUpdateAPIView):
+        results = []
+        for coupon_id in coupon_ids:
+            if coupon_id in coupons:
+                results.append(StripeCouponValidationSerializer(coupons[coupon_id]).data)
+            else:
+                results.append({"coupon_id": coupon_id, "valid": False})
+        return Response({"results": results})
+
+
+class CustomersAPI(UserObjectsMixin, ListCreateAPIView):
     queryset = StripeCustomer.objects.all()
+    serializer_class = StripeCustomerSerializer
+    # default_source_data is computed from sources
+    only_fields = ("id", "stripe_customer_id", "is_active", "sources", "default_source", "created")
+
+    def get_serializer_class(self):
+        if self.request.method == "GET":
+            return StripeCustomerListSerializer
+        return super(CustomersAPI, self).get_serializer_class()
+
+
+class CustomerDetailsAPI(ConditionalRetrieveMixin, RetrieveUpdateAPIView):
+    queryset = StripeCustomer.objects.with_json()
     serializer_class = StripeCustomerDetailsSerializer
     permission_classes = (IsAuthenticated,)
     lookup_field = "stripe_customer_id"
@@ -34,6 +170,18 @@ class CustomerDetailsAPI(RetrieveUpdateAPIView):
         return super().get_queryset().filter(user=self.request.user)
 
 
+class ChargesAPI(UserObjectsMixin, ListAPIView):
+    queryset = StripeCharge.objects.all()
+    serializer_class = StripeChargeSerializer
+    only_fields = StripeChargeSerializer.Meta.fields
+
+
+class SubscriptionsAPI(UserObjectsMixin, ListAPIView):
+    queryset = StripeSubscription.objects.all()
+    serializer_class = StripeSubscriptionSerializer
+    only_fields = StripeSubscriptionSerializer.Meta.fields
+
+
 class WebhookAPI(CreateAPIView):
     queryset = StripeWebhook.objects.all()
     serializer_class = StripeWebhookSerializer
@@ -55,7 +203,7 @@ class WebhookAPI(CreateAPIView):
             # Invalid signature
             return Response(status=400, data={"message": str(e)})
         data = {
-            "raw_data": json.loads(str(event)),
+            "raw_data": to_dict(event),
             "id": event["id"],
         }
         try:
@@ -2,13 +2,17 @@
 from django.urls import re_path
 from rest_framework.routers import DefaultRouter
 
-from aa_stripe.api import CouponDetailsAPI, CustomerDetailsAPI, CustomersAPI, WebhookAPI
+from aa_stripe.api import (ChargesAPI, CouponDetailsAPI, CouponsValidationAPI, CustomerDetailsAPI, CustomersAPI,
+                           SubscriptionsAPI, WebhookAPI)
 
 urlpatterns = [
-    re_path(r"^aa-stripe/coupons/(?P<coupon_id>.*)$", CouponDetailsAPI.as_view(), name="stripe-coupon-details"),
+    re_path(r"^aa-stripe/coupons$", CouponsValidationAPI.as_view(), name="stripe-coupons-validation"),
+    re_path(r"^aa-stripe/coupons/(?P<coupon_id>[^/]+)$", CouponDetailsAPI.as_view(), name="stripe-coupon-details"),
     re_path(r"^aa-stripe/customers$", CustomersAPI.as_view(), name="stripe-customers"),
     re_path(r"^aa-stripe/customers/(?P<stripe_customer_id>[\w\-]+)$", CustomerDetailsAPI.as_view(),
             name="stripe-customer-details"),
+    re_path(r"^aa-stripe/charges$", ChargesAPI.as_view(), name="stripe-charges"),
+    re_path(r"^aa-stripe/subscriptions$", SubscriptionsAPI.as_view(), name="stripe-subscriptions"),
     re_path(r"^aa-stripe/webhooks$", WebhookAPI.as_view(), name="stripe-webhooks")
 ]
 
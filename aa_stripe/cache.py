@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user cache of the billing state, used by the cached lookups on hot request paths, for example
+StripeCustomer.get_cached_active_customer_for_user().
+
+The values are stored in the cache configured by the STRIPE_CACHE_ALIAS setting, under keys versioned per user.
+All the keys of a user are invalidated at once by changing the version, which is done when StripeCustomer or
+StripeSubscription objects are saved or deleted, and also when they are updated in bulk (refresh commands, webhooks),
+after the transaction is committed.
+
+Coupons are cached by coupon_id (see StripeCoupon.get_cached_coupon()), also unknown ones, and invalidated when they
+are saved, deleted, updated by the refresh_coupons command or by webhooks, after the transaction is committed.
+
+Lookups can also be memoized within a block of code, for example a request (see aa_stripe.middleware) or a batch:
+
+with memoize():
+    StripeCustomer.get_latest_active_customer_for_user(user)  # a single query for repeated calls
+"""
+from __future__ import unicode_literals
+
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from time import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from aa_stripe.settings import stripe_settings
+
+KEY_PREFIX = "aa-stripe"
+
+# values memoized in the current memoize() block, by (user_id, name)
+_memo = ContextVar("aa_stripe_memo", default=None)
+
+
+def get_cache():
+    return caches[stripe_settings.CACHE_ALIAS]
+
+
+def _get_version_key(user_id):
+    return "{}:user:{}:version".format(KEY_PREFIX, user_id)
+
+
+def _get_key(user_id, name):
+    cache = get_cache()
+    version_key = _get_version_key(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        # do not start from 1, so the keys of an evicted version are never used again
+        version = int(time() * 1000)
+        if not cache.add(version_key, version, timeout=None):
+            version = cache.get(version_key, version)
+    return "{}:user:{}:{}:{}".format(KEY_PREFIX, user_id, version, name)
+
+
+def get_user_value(user_id, name, get_value):
+    """Returns the cached value of the user, get_value() is called to get the value if it is not cached"""
+    cache = get_cache()
+    key = _get_key(user_id, name)
+    # values are wrapped in a list, so None can be cached as well
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0]
+
+    value = get_value()
+    cache.set(key, [value], timeout=stripe_settings.CACHE_TIMEOUT)
+    return value
+
+
+@contextmanager
+def memoize():
+    """Memoize the values passed to get_memoized_user_value() within the block, blocks can be nested"""
+    token = _memo.set({}) if _memo.get() is None else None
+    try:
+        yield
+    finally:
+        if token is not None:
+            _memo.reset(token)
+
+
+def get_memoized_user_value(user_id, name, get_value):
+    """Returns the value memoized in the current memoize() block, get_value() is called outside of the blocks"""
+    memo = _memo.get()
+    if memo is None:
+        return get_value()
+
+    key = (user_id, name)
+    if key not in memo:
+        memo[key] = get_value()
+    return memo[key]
+
+
+def invalidate_user(user_id):
+    """
+    Invalidate all the cached and memoized values of the user. Cached values are invalidated when the current
+    transaction is committed, otherwise other processes could cache the old state again before the commit.
+    """
+    invalidate_users([user_id])
+
+
+def invalidate_users(user_ids):
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    memo = _memo.get()
+    if memo:
+        for key in [key for key in memo if key[0] in user_ids]:
+            del memo[key]
+
+    if user_ids:
+        transaction.on_commit(partial(_incr_versions, user_ids))
+
+
+def _incr_versions(user_ids):
+    cache = get_cache()
+    for user_id in user_ids:
+        try:
+            cache.incr(_get_version_key(user_id))
+        except ValueError:
+            # the version is not set, new keys will be used anyway
+            pass
+
+
+def _get_coupon_key(coupon_id):
+    # coupon ids are chosen by users, so they are hashed to get valid keys for every cache backend
+    return "{}:coupon:{}".format(KEY_PREFIX, hashlib.sha1(coupon_id.encode("utf-8")).hexdigest())
+
+
+def get_coupon_value(coupon_id, get_value):
+    """Returns the cached value of the coupon, get_value() is called to get the value if it is not cached"""
+    cache = get_cache()
+    key = _get_coupon_key(coupon_id)
+    # values are wrapped in a list, so unknown coupons (None) can be cached as well
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0]
+
+    value = get_value()
+    cache.set(key, [value], timeout=stripe_settings.CACHE_TIMEOUT)
+    return value
+
+
+def invalidate_coupons(coupon_ids):
+    """Invalidate the cached coupons when the current transaction is committed (see invalidate_user())"""
+    keys = [_get_coupon_key(coupon_id) for coupon_id in set(coupon_ids)]
+    if keys:
+        transaction.on_commit(partial(get_cache().delete_many, keys))
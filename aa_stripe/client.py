@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration of the Stripe API client used by aa-stripe.
+
+stripe-python keeps its configuration in module globals. Call configure_stripe() before calling Stripe API, it sets
+them once per process (and again after STRIPE_* settings change), so threads calling Stripe API concurrently never
+see a partially applied configuration. The API key is not set globally, it is passed to each call by
+get_request_options():
+
+configure_stripe()
+stripe.Customer.retrieve("cus_xyz", **get_request_options())
+
+All the calls share a pool of keep-alive connections, so TLS handshakes are not repeated for every call.
+The client is set as stripe.default_http_client, so it replaces the HTTP client of the whole process, including the
+calls made by other code using the stripe module. The pool is configured by the STRIPE_HTTP_POOL_SIZE, STRIPE_HTTP_CONNECT_TIMEOUT, STRIPE_HTTP_READ_TIMEOUT,
+STRIPE_MAX_NETWORK_RETRIES and STRIPE_HTTP_WARM_UP settings.
+
+Calls made by aa-stripe use STRIPE_API_KEY by default. Other accounts or Connect accounts can be used within a block
+of code, the API key and the Stripe account are then passed to each call, so concurrent threads or tasks can use
+different accounts:
+
+with stripe_account_context(api_key="sk_live_other", stripe_account="acct_xyz"):
+    charge.charge()
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+import stripe
+from django.test.signals import setting_changed
+
+from aa_stripe.settings import stripe_settings
+
+logger = logging.getLogger("aa-stripe")
+
+_lock = threading.Lock()
+_configured = False
+
+# (api_key, stripe_account) used in the current stripe_account_context() block
+_account = ContextVar("aa_stripe_account", default=(None, None))
+
+
+def create_session():
+    """Returns a requests session using a pool of keep-alive connections, which can be shared by threads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=stripe_settings.HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_timeout():
+    """Returns the (connect, read) timeout of Stripe API requests"""
+    return stripe_settings.HTTP_CONNECT_TIMEOUT, stripe_settings.HTTP_READ_TIMEOUT
+
+
+def create_http_client(session, timeout):
+    """Returns a Stripe HTTP client sending the requests through the session"""
+    return stripe.http_client.RequestsClient(timeout=timeout, session=session)
+
+
+def warm_up(session, timeout):
+    """Opens a connection to Stripe API in advance, so the first call does not have to wait for the TLS handshake"""
+    try:
+        session.head(stripe.api_base, timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning("[AA-Stripe] cannot connect to Stripe API: {}".format(e))
+
+
+def configure_stripe():
+    """
+    Configures the stripe module according to aa-stripe settings, if it is not configured yet.
+    stripe.default_http_client is replaced process-wide, stripe.max_network_retries is only set if
+    STRIPE_MAX_NETWORK_RETRIES is set.
+    """
+    global _configured
+    if _configured:
+        return
+
+    with _lock:
+        if _configured:
+            return
+
+        session = create_session()
+        timeout = get_timeout()
+        if stripe_settings.HTTP_WARM_UP:
+            warm_up(session, timeout)
+        if stripe_settings.MAX_NETWORK_RETRIES is not None:
+            stripe.max_network_retries = stripe_settings.MAX_NETWORK_RETRIES
+        stripe.default_http_client = create_http_client(session, timeout)
+        _configured = True
+
+
+@contextmanager
+def stripe_account_context(api_key=None, stripe_account=None):
+    """Use the API key and/or the Stripe account for the calls made within the block, blocks can be nested"""
+    current_api_key, current_stripe_account = _account.get()
+    token = _account.set((api_key or current_api_key, stripe_account or current_stripe_account))
+    try:
+        yield
+    finally:
+        _account.reset(token)
+
+
+def get_request_options():
+    """
+    Returns the API key and the Stripe account of the current context to pass to Stripe API calls as keyword arguments.
+    Outside of stripe_account_context() blocks the calls use STRIPE_API_KEY.
+    """
+    api_key, stripe_account = _account.get()
+    options = {"api_key": api_key or stripe_settings.API_KEY}
+    if stripe_account:
+        options["stripe_account"] = stripe_account
+    return options
+
+
+def reset_configuration(*args, **kwargs):
+    global _configured
+    if kwargs.get("setting", "STRIPE_").startswith("STRIPE_"):
+        with _lock:
+            _configured = False
+
+
+setting_changed.connect(reset_configuration)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import sys
+import traceback
+
+from django.core.management.base import BaseCommand
+
+try:
+    from raven.contrib.django.raven_compat.models import client
+except ImportError:
+    pass
+
+
+def report_failures(failures, action, verbose_name="object"):
+    """
+    Reports failures (dicts with obj, exc_type, exc_value and exc_traceback keys, for example returned by
+    StripeSubscription.end_subscriptions()) to Sentry if raven is enabled, otherwise prints them.
+    Returns the failures which were not reported to Sentry.
+    """
+    exceptions = []
+    for failure in failures:
+        try:
+            if client.is_enabled():
+                client.captureException(exc_info=(failure["exc_type"], failure["exc_value"], failure["exc_traceback"]))
+                continue
+        except NameError:
+            pass
+        exceptions.append(failure)
+
+    for e in exceptions:
+        print("Exception happened")
+        print("{} id: {}".format(verbose_name.capitalize(), e["obj"].id))
+        traceback.print_exception(e["exc_type"], e["exc_value"], e["exc_traceback"], file=sys.stdout)
+    if failures:
+        print("Failed to {} {} {}(s): {}".format(
+            action, len(failures), verbose_name, ", ".join(str(failure["obj"].id) for failure in failures)))
+    return exceptions
+
+
+class StripeSyncCommand(BaseCommand):
+    """Base class for commands mirroring Stripe objects with aa_stripe.sync.StripeSync subclasses"""
+
+    sync_class = None
+    verbose_name_plural = "objects"
+    stats_verbosity = 2  # minimal verbosity level at which the stats are printed
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Fetch data from Stripe and report the changes without saving them."
+        )
+        parser.add_argument(
+            "--starting-after",
+            help="Id of the last Stripe object processed by an interrupted run. Use it to resume the run."
+        )
+
+    def get_sync(self, options):
+        return self.sync_class(dry_run=options["dry_run"], starting_after=options["starting_after"])
+
+    def handle(self, *args, **options):
+        if options["verbosity"] >= 2:
+            print("Began refreshing {}".format(self.verbose_name_plural))
+
+        sync = self.get_sync(options)
+        try:
+            sync.run()
+        except Exception:
+            if sync.checkpoint:
+                print("Refreshing {} interrupted, use --starting-after={} to resume".format(
+                    self.verbose_name_plural, sync.checkpoint))
+            raise
+
+        if options["verbosity"] >= self.stats_verbosity:
+            self.print_stats(sync)
+
+    def print_stats(self, sync):
+        print("{name} {dry_run}created: {created}, updated: {updated}, unchanged: {unchanged}, "
+              "missing locally: {missing}, errors: {errors} (took {duration:2f}s)".format(
+                  name=self.verbose_name_plural.capitalize(), dry_run="(dry run) " if sync.dry_run else "",
+                  **sync.stats))
@@ -3,11 +3,11 @@ import sys
 import traceback
 from time import sleep
 
-import stripe
 from django.core.management.base import BaseCommand
 
+from aa_stripe.cache import memoize
+from aa_stripe.client import configure_stripe
 from aa_stripe.models import StripeCharge
-from aa_stripe.settings import stripe_settings
 
 try:
     from raven.contrib.django.raven_compat.models import client
@@ -20,26 +20,27 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         charges = StripeCharge.objects.filter(is_charged=False, charge_attempt_failed=False, is_manual_charge=False)
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
         exceptions = []
-        for c in charges:
-            try:
-                c.charge()
-                sleep(0.25)  # 4 requests per second tops
-            except Exception:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
+        with memoize():  # customers of users with many charges are read once
+            for c in charges:
                 try:
-                    if client.is_enabled():
-                        client.captureException()
-                    else:
-                        raise
-                except NameError:
-                    exceptions.append({
-                        "obj": c,
-                        "exc_type": exc_type,
-                        "exc_value": exc_value,
-                        "exc_traceback": exc_traceback,
-                    })
+                    c.charge()
+                    sleep(0.25)  # 4 requests per second tops
+                except Exception:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    try:
+                        if client.is_enabled():
+                            client.captureException()
+                        else:
+                            raise
+                    except NameError:
+                        exceptions.append({
+                            "obj": c,
+                            "exc_type": exc_type,
+                            "exc_value": exc_value,
+                            "exc_traceback": exc_traceback,
+                        })
 
         for e in exceptions:
             print("Exception happened")
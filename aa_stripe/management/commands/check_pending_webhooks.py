@@ -6,6 +6,7 @@ from django.core.mail import mail_admins
 from django.core.management.base import BaseCommand
 from django.utils.timezone import now
 
+from aa_stripe.client import configure_stripe, get_request_options
 from aa_stripe.models import StripeWebhook
 from aa_stripe.settings import stripe_settings
 
@@ -36,7 +37,7 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
 
         site_id = options.get("site")
         site = Site.objects.get(pk=site_id) if site_id else Site.objects.all()[0]
@@ -45,12 +46,13 @@ class Command(BaseCommand):
         last_event_id = last_event.id if last_event else None
         try:
             if last_event:
-                stripe.Event.retrieve(last_event_id)
+                stripe.Event.retrieve(last_event_id, **get_request_options())
         except stripe.error.InvalidRequestError:
             last_event_id = None
 
         while True:
-            event_list = stripe.Event.list(ending_before=last_event_id, limit=100)  # 100 is the maximum
+            event_list = stripe.Event.list(
+                ending_before=last_event_id, limit=100, **get_request_options())  # 100 is the maximum
             pending_webhooks += event_list["data"]
 
             if len(pending_webhooks) > stripe_settings.PENDING_WEBHOOKS_THRESHOLD:
@@ -1,53 +1,61 @@
 # -*- coding: utf-8 -*-
 import sys
-import traceback
 from time import sleep
 
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
 
+from aa_stripe.management.base import report_failures
 from aa_stripe.models import StripeSubscription
 
-try:
-    from raven.contrib.django.raven_compat.models import client
-except ImportError:
-    pass
-
 
 class Command(BaseCommand):
     """
     Terminates outdated subscriptions at period end.
 
-    Should be run hourly.
-    Exceptions are queued and returned at the end.
+    Should be run hourly, or started with --interval to keep running and cancel subscriptions as soon as they
+    are due.
+    Subscriptions are canceled concurrently, exceptions are queued and returned at the end.
     """
 
     help = "Terminate outdated subscriptions"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int,
+            help="Number of subscriptions canceled at the same time (default: STRIPE_WORKERS setting)."
+        )
+        parser.add_argument(
+            "--rate-limit", type=float,
+            help="Maximum number of Stripe API calls per second (default: STRIPE_API_RATE_LIMIT setting)."
+        )
+        parser.add_argument(
+            "--interval", type=int,
+            help="Keep running, checking for due subscriptions at least every INTERVAL seconds."
+        )
+
     def handle(self, *args, **options):
-        subscriptions = StripeSubscription.get_subcriptions_for_cancel()
-        exceptions = []
-        for subscription in subscriptions:
-            try:
-                subscription.cancel(at_period_end=True)
-                sleep(0.25)  # 4 requests per second tops
-            except Exception:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                try:
-                    if client.is_enabled():
-                        client.captureException()
-                    else:
-                        raise
-                except NameError:
-                    exceptions.append({
-                        "obj": subscription,
-                        "exc_type": exc_type,
-                        "exc_value": exc_value,
-                        "exc_traceback": exc_traceback,
-                    })
-
-        for e in exceptions:
-            print("Exception happened")
-            print("Subscription id: {obj.id}".format(obj=e["obj"]))
-            traceback.print_exception(e["exc_type"], e["exc_value"], e["exc_traceback"], file=sys.stdout)
-        if exceptions:
-            sys.exit(1)
+        interval = options.get("interval")
+        if not interval:
+            if self.end_subscriptions(options):
+                sys.exit(1)
+            return
+
+        try:
+            while True:
+                # the connection could be closed by the database while sleeping, the same way as between requests
+                close_old_connections()
+                self.end_subscriptions(options)
+                timeout = interval
+                next_end_at = StripeSubscription.get_next_end_at()
+                if next_end_at:
+                    timeout = min(timeout, (next_end_at - timezone.now()).total_seconds())
+                sleep(max(timeout, 0))
+        except KeyboardInterrupt:
+            pass
+
+    def end_subscriptions(self, options):
+        failures = StripeSubscription.end_subscriptions(
+            at_period_end=True, workers=options.get("workers"), rate_limit=options.get("rate_limit"))
+        return report_failures(failures, "terminate", verbose_name="subscription")
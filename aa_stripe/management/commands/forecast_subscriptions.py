@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from aa_stripe.models import StripeSubscription
+
+
+class Command(BaseCommand):
+    """Prints the expected number of subscription renewals and cancels for each of the next days"""
+
+    help = "Forecast subscription renewals and cancels"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="Number of days to forecast (default: 30).")
+
+    def handle(self, *args, **options):
+        forecast = StripeSubscription.forecast(days=options["days"])
+        print("date        renewals  cancels")
+        for day in forecast:
+            print("{date:%Y-%m-%d}  {renewals:>8}  {cancels:>7}".format(**day))
+        print("total       {:>8}  {:>7}".format(
+            sum(day["renewals"] for day in forecast), sum(day["cancels"] for day in forecast)))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import sys
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aa_stripe.management.base import report_failures
+from aa_stripe.models import StripeSubscription, StripeSubscriptionPlan
+
+
+class Command(BaseCommand):
+    """
+    Moves subscriptions from one plan to another, for example when repricing.
+
+    Can be run again with the --token printed by the interrupted migration to resume it, already migrated subscriptions
+    are skipped.
+    """
+
+    help = "Move subscriptions from one plan to another"
+
+    def add_arguments(self, parser):
+        parser.add_argument("from_plan", type=int, help="Id of the plan to move the subscriptions from.")
+        parser.add_argument("to_plan", type=int, help="Id of the plan to move the subscriptions to.")
+        parser.add_argument(
+            "--status", action="append", dest="statuses",
+            choices=[status for status, label in StripeSubscription.STATUS_CHOICES],
+            help="Move only subscriptions with the given status, can be used multiple times (default: all but "
+                 "canceled)."
+        )
+        parser.add_argument(
+            "--no-prorate", action="store_false", dest="prorate",
+            help="Do not prorate the changes of the subscription price."
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only print the number of subscriptions to move.")
+        parser.add_argument(
+            "--token",
+            help="Token of an interrupted migration to resume, used in the idempotency keys (default: a new token)."
+        )
+        parser.add_argument(
+            "--workers", type=int,
+            help="Number of subscriptions updated at the same time (default: STRIPE_WORKERS setting)."
+        )
+        parser.add_argument(
+            "--rate-limit", type=float,
+            help="Maximum number of Stripe API calls per second (default: STRIPE_API_RATE_LIMIT setting)."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from_plan = StripeSubscriptionPlan.objects.get_cached(options["from_plan"])
+            to_plan = StripeSubscriptionPlan.objects.get_cached(options["to_plan"])
+        except StripeSubscriptionPlan.DoesNotExist:
+            raise CommandError("Both plans have to exist and the new plan has to be created at Stripe.")
+        if not to_plan.is_created_at_stripe:
+            raise CommandError("Both plans have to exist and the new plan has to be created at Stripe.")
+
+        count = StripeSubscription.get_subscriptions_to_migrate(from_plan, statuses=options["statuses"]).count()
+        if options["dry_run"]:
+            print("{} subscription(s) would be moved from plan {} to plan {}".format(count, from_plan.id, to_plan.id))
+            return
+
+        token = options.get("token") or uuid4().hex
+        print("Moving subscriptions, use --token={} to resume the migration if it is interrupted".format(token))
+        failures = StripeSubscription.migrate_plan(
+            from_plan, to_plan, statuses=options["statuses"], prorate=options["prorate"],
+            workers=options.get("workers"), rate_limit=options.get("rate_limit"), token=token)
+        print("Moved {} subscription(s) from plan {} to plan {}".format(
+            count - len(failures), from_plan.id, to_plan.id))
+        if report_failures(failures, "move", verbose_name="subscription"):
+            sys.exit(1)
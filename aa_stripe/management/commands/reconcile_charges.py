@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from aa_stripe.management.base import StripeSyncCommand
+from aa_stripe.sync import ChargeReconcileSync
+
+
+class Command(StripeSyncCommand):
+    """
+    Corrects is_charged, amount_refunded and is_refunded of charges created in the given time window.
+
+    Refunds made in the Stripe Dashboard are not visible in the app otherwise. Should be run daily.
+    """
+
+    help = "Reconcile charges and refunds with Stripe API"
+    sync_class = ChargeReconcileSync
+    verbose_name_plural = "charges"
+    stats_verbosity = 1  # the drift report is printed by default
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--since", help="Reconcile charges created on or after the date (YYYY-MM-DD). Default: 30 days ago."
+        )
+        parser.add_argument("--until", help="Reconcile charges created before the date (YYYY-MM-DD).")
+
+    def _parse_date(self, value):
+        try:
+            return timezone.make_aware(datetime.combine(datetime.strptime(value, "%Y-%m-%d").date(), time.min))
+        except ValueError:
+            raise CommandError("Invalid date: {}, use the YYYY-MM-DD format".format(value))
+
+    def get_sync(self, options):
+        if options["since"]:
+            created_after = self._parse_date(options["since"])
+        else:
+            created_after = timezone.now() - timedelta(days=30)
+        created_before = self._parse_date(options["until"]) if options["until"] else None
+        return self.sync_class(
+            created_after=created_after, created_before=created_before, dry_run=options["dry_run"],
+            starting_after=options["starting_after"]
+        )
+
+    def print_stats(self, sync):
+        super(Command, self).print_stats(sync)
+        print("Drift found - is_charged: {is_charged_drift}, is_refunded: {is_refunded_drift}, "
+              "amount_refunded: {amount_refunded_drift} (total {refunded_amount_drift} cents), "
+              "disputed charges: {disputed}".format(**sync.stats))
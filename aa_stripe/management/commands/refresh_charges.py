@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from aa_stripe.management.base import StripeSyncCommand
+from aa_stripe.sync import ChargeSync
+
+
+class Command(StripeSyncCommand):
+    help = "Update charges and refunds data from Stripe API"
+    sync_class = ChargeSync
+    verbose_name_plural = "charges"
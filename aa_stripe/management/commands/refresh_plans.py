@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import CommandError
+
+from aa_stripe.management.base import StripeSyncCommand
+from aa_stripe.models import StripeSubscriptionPlan
+from aa_stripe.sync import PlanSync
+
+
+class Command(StripeSyncCommand):
+    """
+    Updates plans with data listed from Stripe API, plans created in Stripe dashboard are created locally.
+
+    With --provision, plans which have not been created at Stripe yet are created there first, for example on deploy.
+    """
+
+    help = "Update subscription plans data from Stripe API"
+    sync_class = PlanSync
+    verbose_name_plural = "plans"
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--provision", action="store_true", default=False,
+            help="Create plans which have not been created at Stripe yet before refreshing."
+        )
+
+    def handle(self, *args, **options):
+        failures = []
+        if options["provision"] and not options["dry_run"]:
+            failures = StripeSubscriptionPlan.create_all_at_stripe()
+            for failure in failures:
+                print("Cannot create plan {} at Stripe: {}".format(failure["obj"].id, failure["exc_value"]))
+
+        super(Command, self).handle(*args, **options)
+        if failures:
+            raise CommandError("Failed to create {} plan(s) at Stripe".format(len(failures)))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from aa_stripe.management.base import StripeSyncCommand
+from aa_stripe.models import StripeSubscription
+from aa_stripe.sync import SubscriptionSync
+
+
+class Command(StripeSyncCommand):
+    """
+    Updates status, cancellation data and stripe_response of subscriptions with data listed from Stripe API.
+
+    Should be run before end_subscriptions, which relies on the local status of subscriptions.
+    """
+
+    help = "Update subscriptions data from Stripe API"
+    sync_class = SubscriptionSync
+    verbose_name_plural = "subscriptions"
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--status", default="all",
+            choices=["all"] + [status for status, label in StripeSubscription.STATUS_CHOICES],
+            help="Refresh only subscriptions with the given status at Stripe (default: all)."
+        )
+
+    def get_sync(self, options):
+        return self.sync_class(
+            status=options["status"], dry_run=options["dry_run"], starting_after=options["starting_after"])
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from aa_stripe.cache import memoize
+
+
+class MemoizeMiddleware(object):
+    """Memoizes lookups of the billing state of users (see aa_stripe.cache.memoize) for the duration of a request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with memoize():
+            return self.get_response(request)
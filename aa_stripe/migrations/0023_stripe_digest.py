@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0022_stripecharge_amount_refunded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripecoupon',
+            name='stripe_digest',
+            field=models.CharField(blank=True, editable=False, help_text='Digest of Stripe data used in the last update', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='stripecustomer',
+            name='stripe_digest',
+            field=models.CharField(blank=True, editable=False, help_text='Digest of Stripe data used in the last update', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='stripesubscription',
+            name='stripe_digest',
+            field=models.CharField(blank=True, editable=False, help_text='Digest of Stripe data used in the last update', max_length=40),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0023_stripe_digest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stripesubscription',
+            index=models.Index(fields=['status', 'end_date'], name='aa_stripe_subscription_end'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0024_subscription_end_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripesubscription',
+            name='stripe_event_created',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Creation time of the last webhook event applied', null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:46
+
+from django.db import migrations, models
+
+from aa_stripe.utils import timestamp_to_timezone_aware_date
+
+
+def set_current_period_end(apps, schema_editor):
+    StripeSubscription = apps.get_model("aa_stripe", "StripeSubscription")
+    subscriptions = []
+    for subscription in StripeSubscription.objects.filter(is_created_at_stripe=True).only("stripe_response").iterator():
+        current_period_end = (subscription.stripe_response or {}).get("current_period_end")
+        if current_period_end:
+            subscription.current_period_end = timestamp_to_timezone_aware_date(current_period_end)
+            subscriptions.append(subscription)
+        if len(subscriptions) >= 500:
+            StripeSubscription.objects.bulk_update(subscriptions, ["current_period_end"])
+            subscriptions = []
+    StripeSubscription.objects.bulk_update(subscriptions, ["current_period_end"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0025_stripesubscription_stripe_event_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripesubscription',
+            name='current_period_end',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='https://stripe.com/docs/api/python#subscription_object-current_period_end', null=True),
+        ),
+        migrations.RunPython(
+            code=set_current_period_end,
+            reverse_code=migrations.RunPython.noop,
+            hints={'target_db': 'default'}
+        ),
+    ]
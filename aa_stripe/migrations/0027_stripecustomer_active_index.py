@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0026_stripesubscription_current_period_end'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stripecustomer',
+            index=models.Index(fields=['user', 'is_active', 'id'], name='aa_stripe_customer_active'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0027_stripecustomer_active_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stripecharge',
+            index=models.Index(fields=['user', '-created', '-id'], name='aa_stripe_charge_created'),
+        ),
+        migrations.AddIndex(
+            model_name='stripecustomer',
+            index=models.Index(fields=['user', '-created', '-id'], name='aa_stripe_customer_created'),
+        ),
+        migrations.AddIndex(
+            model_name='stripesubscription',
+            index=models.Index(fields=['user', '-created', '-id'], name='aa_stripe_subscription_created'),
+        ),
+    ]
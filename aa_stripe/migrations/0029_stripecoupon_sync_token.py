@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0028_user_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripecoupon',
+            name='sync_token',
+            field=models.CharField(blank=True, editable=False, help_text='Token of the last full sync which found the coupon', max_length=32),
+        ),
+    ]
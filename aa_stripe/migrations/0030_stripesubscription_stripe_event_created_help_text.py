@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aa_stripe', '0029_stripecoupon_sync_token'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stripesubscription',
+            name='stripe_event_created',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Time of the last Stripe data applied: creation of the webhook event or the Stripe API request', null=True),
+        ),
+    ]
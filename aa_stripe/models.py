@@ -2,10 +2,13 @@
 from __future__ import unicode_literals
 
 import logging
+import sys
+import threading
+from datetime import datetime, time, timedelta
 from decimal import Decimal
-from time import sleep
+from time import monotonic
+from uuid import uuid4
 
-import simplejson as json
 import stripe
 from dateutil.relativedelta import relativedelta
 from django import dispatch
@@ -13,16 +16,24 @@ from django.conf import settings
 from django.contrib.contenttypes import fields as generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import TruncDate
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import dateformat, timezone
 from django.utils.translation import gettext_lazy as _
 from django_extensions.db.fields.json import JSONField
 
+from aa_stripe.cache import (get_coupon_value, get_memoized_user_value, get_user_value, invalidate_coupons,
+                             invalidate_user, invalidate_users)
+from aa_stripe.client import configure_stripe, get_request_options, stripe_account_context
 from aa_stripe.exceptions import (StripeCouponAlreadyExists, StripeInternalError, StripeMethodNotAllowed,
                                   StripeWebhookAlreadyParsed, StripeWebhookParseError)
 from aa_stripe.settings import stripe_settings
-from aa_stripe.signals import stripe_charge_card_exception, stripe_charge_refunded, stripe_charge_succeeded
-from aa_stripe.utils import timestamp_to_timezone_aware_date
+from aa_stripe.signals import (stripe_charge_card_exception, stripe_charge_refunded, stripe_charge_succeeded,
+                               stripe_coupons_deleted)
+from aa_stripe.utils import run_concurrently, stripe_digest, timestamp_to_timezone_aware_date, to_dict
 
 USER_MODEL = getattr(settings, "STRIPE_USER_MODEL", settings.AUTH_USER_MODEL)
 
@@ -32,14 +43,67 @@ logger = logging.getLogger("aa-stripe")
 webhook_pre_parse = dispatch.Signal()
 
 
+class StripeQuerySet(models.query.QuerySet):
+    def with_json(self):
+        """Load the large JSON fields which are deferred by default (see StripeManager)"""
+        return self.defer(None)
+
+
+class StripeManager(models.Manager.from_queryset(StripeQuerySet)):
+    """
+    Defers loading of the large JSON fields listed in the DEFERRED_FIELDS attribute of the model, which are not read
+    in most of the queries (for example in admin changelists or batch jobs). Deferred fields are loaded when they are
+    accessed, use with_json() to load them with the objects.
+    """
+
+    def get_queryset(self):
+        return super(StripeManager, self).get_queryset().defer(*self.model.DEFERRED_FIELDS)
+
+
 class StripeBasicModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     stripe_response = JSONField(blank=True)
 
+    DEFERRED_FIELDS = ["stripe_response"]
+
+    objects = StripeManager()
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def get_stripe_response(cls, stripe_object):
+        """Returns StripeObject converted to a dict, without the fields listed in RESPONSE_EXCLUDE_FIELDS setting"""
+        return to_dict(
+            stripe_object, exclude_fields=stripe_settings.RESPONSE_EXCLUDE_FIELDS.get(stripe_object.get("object")))
+
+
+class SourcesDescriptor(DeferredAttribute):
+    """
+    Descriptor of StripeCustomer.sources, which keeps the first replaced value (_old_sources) and resets the index of
+    sources when the value is replaced. Nothing is copied unless sources are replaced.
+
+    Sources modified in place (for example with sources.append()) are not tracked, assign a new list instead.
+    """
+
+    def __set__(self, instance, value):
+        data = instance.__dict__
+        if self.field.attname in data and "_old_sources" not in data:
+            data["_old_sources"] = data[self.field.attname]
+        data.pop("_sources_by_id", None)
+        data[self.field.attname] = value
+
+
+class SourcesField(JSONField):
+    """JSONField of StripeCustomer.sources, using SourcesDescriptor"""
+    descriptor_class = SourcesDescriptor
+
+    def deconstruct(self):
+        # the descriptor does not affect the database, keep migrations referring to JSONField
+        name, path, args, kwargs = super().deconstruct()
+        return name, "django_extensions.db.fields.json.JSONField", args, kwargs
+
 
 class StripeCustomer(StripeBasicModel):
     user = models.ForeignKey(USER_MODEL, on_delete=models.CASCADE, related_name="stripe_customers")
@@ -47,12 +111,14 @@ class StripeCustomer(StripeBasicModel):
     stripe_customer_id = models.CharField(max_length=255, db_index=True)
     is_active = models.BooleanField(default=True)
     is_created_at_stripe = models.BooleanField(default=False)
-    sources = JSONField(blank=True, default=[])
+    sources = SourcesField(blank=True, default=[])
     default_source = models.CharField(max_length=255, blank=True, help_text="ID of default source from Stripe")
+    stripe_digest = models.CharField(
+        max_length=40, blank=True, editable=False, help_text=_("Digest of Stripe data used in the last update")
+    )
 
-    def __init__(self, *args, **kwargs):
-        super(StripeCustomer, self).__init__(*args, **kwargs)
-        self._old_sources = self.sources  # to track changes in post_save
+    # sources are not deferred, they are needed for default_source_data and change tracking
+    DEFERRED_FIELDS = ["stripe_response", "stripe_js_response"]
 
     def create_at_stripe(self, description=None):
         if self.is_created_at_stripe:
@@ -61,36 +127,56 @@ class StripeCustomer(StripeBasicModel):
         if description is None:
             description = "{user} id: {user.id}".format(user=self.user)
 
-        stripe.api_key = stripe_settings.API_KEY
-        customer = stripe.Customer.create(source=self.stripe_js_response["id"], description=description)
+        configure_stripe()
+        customer = stripe.Customer.create(
+            source=self.stripe_js_response["id"], description=description, **get_request_options())
         self.stripe_customer_id = customer["id"]
-        self.stripe_response = customer
+        self.stripe_response = self.get_stripe_response(customer)
         self.sources = customer.sources.data
         self.default_source = customer.default_source
+        self.stripe_digest = stripe_digest(customer)
         self.is_created_at_stripe = True
         self.save()
         return self
 
     @classmethod
     def get_latest_active_customer_for_user(cls, user):
-        """Returns last active stripe customer for user"""
-        customer = cls.objects.filter(user_id=user.id, is_active=True).last()
-        return customer
+        """Returns last active stripe customer for user, memoized in aa_stripe.cache.memoize() blocks"""
+        return get_memoized_user_value(
+            user.id, "customer", lambda: cls.objects.filter(user_id=user.id, is_active=True).last())
+
+    @classmethod
+    def get_cached_active_customer_for_user(cls, user):
+        """Cached get_latest_active_customer_for_user(), see aa_stripe.cache"""
+        return get_user_value(user.id, "customer", lambda: cls.get_latest_active_customer_for_user(user))
 
     def change_description(self, description):
-        customer = self.retrieve_from_stripe()
-        customer.description = description
-        customer.save()
+        configure_stripe()
+        customer = stripe.Customer.modify(self.stripe_customer_id, description=description, **get_request_options())
+        self.stripe_response = self.get_stripe_response(customer)
+        self._update_from_stripe_object(customer, update_fields=["stripe_response"])
         return customer
 
     def retrieve_from_stripe(self):
-        stripe.api_key = stripe_settings.API_KEY
-        return stripe.Customer.retrieve(self.stripe_customer_id)
+        configure_stripe()
+        return stripe.Customer.retrieve(self.stripe_customer_id, **get_request_options())
+
+    def _update_from_stripe_object(self, stripe_customer, update_fields=None):
+        """
+        Update sources of the customer with data from stripe.Customer.
+
+        The object is not saved if Stripe data has not changed since the last update, unless additional
+        update_fields are passed.
+        """
+        digest = stripe_digest(stripe_customer)
+        update_fields = list(update_fields or [])
+        if digest == self.stripe_digest and not update_fields:
+            return
 
-    def _update_from_stripe_object(self, stripe_customer):
         self.sources = stripe_customer.sources.data
         self.default_source = stripe_customer.default_source or ""
-        self.save()
+        self.stripe_digest = digest
+        self.save(update_fields=update_fields + ["sources", "default_source", "stripe_digest", "updated"])
 
     def refresh_from_stripe(self):
         customer = self.retrieve_from_stripe()
@@ -103,27 +189,46 @@ class StripeCustomer(StripeBasicModel):
         The new source will be automatically set as customer's default payment source.
         Passing stripe_js_response is optional. If set, StripeCustomer.stripe_js_response will be updated.
         """
-        customer = self.retrieve_from_stripe()
-        customer.source = source_token
-        customer.save()
+        configure_stripe()
+        customer = stripe.Customer.modify(self.stripe_customer_id, source=source_token, **get_request_options())
+        update_fields = []
         if stripe_js_response:
             self.stripe_js_response = stripe_js_response
-        self._update_from_stripe_object(customer)
+            update_fields.append("stripe_js_response")
+        self._update_from_stripe_object(customer, update_fields=update_fields)
+
+    @property
+    def _old_sources(self):
+        """Sources before they were first changed since the object was loaded, to track changes in post_save"""
+        return self.__dict__.get("_old_sources", self.sources)
+
+    @_old_sources.setter
+    def _old_sources(self, value):
+        self.__dict__["_old_sources"] = value
+
+    @property
+    def sources_by_id(self):
+        """Dict of sources by id, built on first access and cached until sources are changed"""
+        if "_sources_by_id" not in self.__dict__:
+            self.__dict__["_sources_by_id"] = {source["id"]: source for source in self.sources or []}
+        return self.__dict__["_sources_by_id"]
 
     @property
     def default_source_data(self):
         if not self.default_source:
             return
 
-        for source in self.sources:
-            if source["id"] == self.default_source:
-                return source
+        return self.sources_by_id.get(self.default_source)
 
     class Meta:
         ordering = ["id"]
+        indexes = [
+            models.Index(fields=["user", "is_active", "id"], name="aa_stripe_customer_active"),
+            models.Index(fields=["user", "-created", "-id"], name="aa_stripe_customer_created"),
+        ]
 
 
-class StripeCouponQuerySet(models.query.QuerySet):
+class StripeCouponQuerySet(StripeQuerySet):
     def delete(self):
         # StripeCoupon.delete must be executed (along with post_save)
         deleted_counter = 0
@@ -134,9 +239,9 @@ class StripeCouponQuerySet(models.query.QuerySet):
         return deleted_counter, {self.model._meta.label: deleted_counter}
 
 
-class StripeCouponManager(models.Manager):
+class StripeCouponManager(StripeManager.from_queryset(StripeCouponQuerySet)):
     def all_with_deleted(self):
-        return StripeCouponQuerySet(self.model, using=self._db)
+        return super(StripeCouponManager, self).get_queryset()
 
     def deleted(self):
         return self.all_with_deleted().filter(is_deleted=True)
@@ -144,6 +249,21 @@ class StripeCouponManager(models.Manager):
     def get_queryset(self):
         return self.all_with_deleted().filter(is_deleted=False)
 
+    def mark_deleted(self, pks):
+        """
+        Mark coupons with given primary keys as deleted using a single UPDATE, without calling Stripe API.
+
+        Instead of pre/post save signals for each coupon, stripe_coupons_deleted is sent once with the list of pks.
+        Returns the number of rows altered.
+        """
+        pks = list(pks)
+        if not pks:
+            return 0
+
+        count = self.all_with_deleted().filter(pk__in=pks).update(is_deleted=True, updated=timezone.now())
+        stripe_coupons_deleted.send(sender=self.model, pks=pks)
+        return count
+
 
 class StripeCoupon(StripeBasicModel):
     # fields that are fetched from Stripe API
@@ -270,16 +390,61 @@ class StripeCoupon(StripeBasicModel):
     created = models.DateTimeField()
     is_deleted = models.BooleanField(default=False)
     is_created_at_stripe = models.BooleanField(default=False)
+    stripe_digest = models.CharField(
+        max_length=40, blank=True, editable=False, help_text=_("Digest of Stripe data used in the last update")
+    )
+    sync_token = models.CharField(
+        max_length=32, blank=True, editable=False, help_text=_("Token of the last full sync which found the coupon")
+    )
 
     objects = StripeCouponManager()
 
     def __init__(self, *args, **kwargs):
         super(StripeCoupon, self).__init__(*args, **kwargs)
         self._previous_is_deleted = self.is_deleted
+        self._set_saved_metadata_keys()
+
+    def _set_saved_metadata_keys(self):
+        # keys of the last saved metadata, which have to be unset at Stripe if they are removed (None if unknown,
+        # because the metadata was not loaded)
+        self._saved_metadata_keys = set(self.__dict__["metadata"] or {}) if "metadata" in self.__dict__ else None
+
+    def _get_saved_metadata_keys(self):
+        if self._saved_metadata_keys is not None:
+            return self._saved_metadata_keys
+        return set(StripeCoupon.objects.all_with_deleted().filter(pk=self.pk).values_list(
+            "metadata", flat=True).first() or {})
 
     def __str__(self):
         return self.coupon_id
 
+    def is_redeemable(self):
+        """Whether the coupon can be applied now: it is valid at Stripe, it has not expired or been fully redeemed"""
+        if self.is_deleted or not self.valid:
+            return False
+        if self.redeem_by and self.redeem_by <= timezone.now():
+            return False
+        return self.max_redemptions is None or self.times_redeemed < self.max_redemptions
+
+    @classmethod
+    def get_cached_coupon(cls, coupon_id):
+        """Returns the coupon which is not deleted or None, cached by coupon_id (see aa_stripe.cache)"""
+        return get_coupon_value(coupon_id, lambda: cls.objects.filter(coupon_id=coupon_id).order_by("-created").first())
+
+    @classmethod
+    def get_data_from_stripe(cls, stripe_coupon, exclude_fields=None):
+        """Returns values of STRIPE_FIELDS converted from stripe.Coupon data"""
+        fields_to_update = cls.STRIPE_FIELDS - set(exclude_fields or [])
+        data = {key: stripe_coupon[key] for key in fields_to_update}
+        for field in ["created", "redeem_by"]:
+            if data.get(field):
+                data[field] = timestamp_to_timezone_aware_date(data[field])
+
+        if data.get("amount_off"):
+            data["amount_off"] = Decimal(data["amount_off"]) / 100
+
+        return data
+
     def update_from_stripe_data(self, stripe_coupon, exclude_fields=None, commit=True):
         """
         Update StripeCoupon object with data from stripe.Coupon without calling stripe.Coupon.retrieve.
@@ -287,21 +452,19 @@ class StripeCoupon(StripeBasicModel):
         To only update the object, set the commit param to False.
         Returns the number of rows altered or None if commit is False.
         """
-        fields_to_update = self.STRIPE_FIELDS - set(exclude_fields or [])
-        update_data = {key: stripe_coupon[key] for key in fields_to_update}
-        for field in ["created", "redeem_by"]:
-            if update_data.get(field):
-                update_data[field] = timestamp_to_timezone_aware_date(update_data[field])
-
-        if update_data.get("amount_off"):
-            update_data["amount_off"] = Decimal(update_data["amount_off"]) / 100
+        update_data = self.get_data_from_stripe(stripe_coupon, exclude_fields=exclude_fields)
+        update_data["updated"] = timezone.now()  # auto_now is not applied by update()
 
         # also make sure the object is up to date (without the need to call database)
         for key, value in update_data.items():
             setattr(self, key, value)
 
         if commit:
-            return StripeCoupon.objects.filter(pk=self.pk).update(**update_data)
+            count = StripeCoupon.objects.filter(pk=self.pk).update(**update_data)
+            invalidate_coupons([self.coupon_id])  # update() does not send post_save signal
+            if "metadata" in update_data:
+                self._set_saved_metadata_keys()
+            return count
 
     def save(self, force_retrieve=False, *args, **kwargs):
         """
@@ -309,10 +472,10 @@ class StripeCoupon(StripeBasicModel):
 
         API or update the local object with data fetched from Stripe.
         """
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
         if self._previous_is_deleted != self.is_deleted and self.is_deleted:
             try:
-                stripe_coupon = stripe.Coupon.retrieve(self.coupon_id)
+                stripe_coupon = stripe.Coupon.retrieve(self.coupon_id, **get_request_options())
                 # make sure to delete correct coupon
                 if self.created == timestamp_to_timezone_aware_date(stripe_coupon["created"]):
                     stripe_coupon.delete()
@@ -324,10 +487,14 @@ class StripeCoupon(StripeBasicModel):
 
         if self.pk or force_retrieve:
             try:
-                stripe_coupon = stripe.Coupon.retrieve(self.coupon_id)
-                if not force_retrieve:
-                    stripe_coupon.metadata = self.metadata
-                    stripe_coupon.save()
+                if force_retrieve:
+                    stripe_coupon = stripe.Coupon.retrieve(self.coupon_id, **get_request_options())
+                else:
+                    # only metadata can be changed, keys removed since the last save have to be unset explicitly
+                    # (stripe_response is not updated by syncs and webhooks, it cannot be used here)
+                    metadata = {key: "" for key in self._get_saved_metadata_keys()}
+                    metadata.update(self.metadata or {})
+                    stripe_coupon = stripe.Coupon.modify(self.coupon_id, metadata=metadata, **get_request_options())
 
                 if force_retrieve:
                     # make sure we are not creating a duplicate
@@ -339,19 +506,18 @@ class StripeCoupon(StripeBasicModel):
                     for coupon in coupon_qs:
                         coupon.is_deleted = True
                         super(StripeCoupon, coupon).save()  # use super save() to call pre/post save signals
-                # update all fields in the local object in case someone tried to change them
-                self.update_from_stripe_data(
-                    stripe_coupon,
-                    exclude_fields=["metadata"] if not force_retrieve else [],
-                )
-                self.stripe_response = stripe_coupon
+                # update all fields in the local object in case someone tried to change them, the metadata has to be
+                # updated as well, syncs skip coupons with the same digest (the object is saved below)
+                self.update_from_stripe_data(stripe_coupon, commit=False)
+                self.stripe_response = self.get_stripe_response(stripe_coupon)
+                self.stripe_digest = stripe_digest(stripe_coupon)
             except stripe.error.InvalidRequestError:
                 if force_retrieve:
                     raise
 
                 self.is_deleted = True
         else:
-            self.stripe_response = stripe.Coupon.create(
+            stripe_coupon = stripe.Coupon.create(
                 id=self.coupon_id,
                 duration=self.duration,
                 amount_off=int(self.amount_off * 100) if self.amount_off else None,
@@ -361,15 +527,26 @@ class StripeCoupon(StripeBasicModel):
                 metadata=self.metadata,
                 percent_off=self.percent_off,
                 redeem_by=int(dateformat.format(self.redeem_by, "U")) if self.redeem_by else None,
+                **get_request_options(),
+            )
+            # fields set by Stripe (valid, times_redeemed, livemode) have to be stored with the digest
+            self.update_from_stripe_data(
+                stripe_coupon,
+                exclude_fields=self.STRIPE_FIELDS - {"valid", "times_redeemed", "livemode"},
+                commit=False,
             )
+            self.stripe_response = self.get_stripe_response(stripe_coupon)
+            self.stripe_digest = stripe_digest(stripe_coupon)
             # stripe will generate coupon_id if none was specified in the request
             if not self.coupon_id:
-                self.coupon_id = self.stripe_response["id"]
+                self.coupon_id = stripe_coupon["id"]
 
         self.created = timestamp_to_timezone_aware_date(self.stripe_response["created"])
         # for future
         self.is_created_at_stripe = True
-        return super(StripeCoupon, self).save(*args, **kwargs)
+        result = super(StripeCoupon, self).save(*args, **kwargs)
+        self._set_saved_metadata_keys()
+        return result
 
     def delete(self, *args, **kwargs):
         self.is_deleted = True
@@ -396,13 +573,16 @@ class StripeCharge(StripeBasicModel):
     source = generic.GenericForeignKey("content_type", "object_id")
     statement_descriptor = models.CharField(max_length=22, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "-created", "-id"], name="aa_stripe_charge_created")]
+
     def charge(self, idempotency_key=None, payment_uuid=None):
         self.refresh_from_db()  # to minimize the chance of double charging
 
         if self.is_charged:
             raise StripeMethodNotAllowed("Already charged.")
 
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
         customer = StripeCustomer.get_latest_active_customer_for_user(self.user)
         self.customer = customer
         if customer:
@@ -432,7 +612,7 @@ class StripeCharge(StripeBasicModel):
                 params["statement_descriptor"] = self.statement_descriptor
 
             try:
-                stripe_charge = stripe.Charge.create(idempotency_key=idempotency_key, **params)
+                stripe_charge = stripe.Charge.create(idempotency_key=idempotency_key, **params, **get_request_options())
             except stripe.error.CardError as e:
                 self.charge_attempt_failed = True
                 self.is_charged = False
@@ -463,14 +643,14 @@ class StripeCharge(StripeBasicModel):
                 self.save()
                 raise
             self.stripe_charge_id = stripe_charge["id"]
-            self.stripe_response = stripe_charge
+            self.stripe_response = self.get_stripe_response(stripe_charge)
             self.is_charged = True
             self.save()
             stripe_charge_succeeded.send(sender=StripeCharge, instance=self)
             return stripe_charge
 
     def refund(self, amount_to_refund=None, retry_on_error=True):
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
 
         if not self.is_charged:
             raise StripeMethodNotAllowed("Cannot refund not charged transaction.")
@@ -498,6 +678,7 @@ class StripeCharge(StripeBasicModel):
                 idempotency_key=idempotency_key,
                 charge=self.stripe_charge_id,
                 amount=amount_to_refund,
+                **get_request_options(),
             )
             refund_id = stripe_refund["id"]
         except stripe.error.InvalidRequestError as e:
@@ -509,7 +690,7 @@ class StripeCharge(StripeBasicModel):
                 # Ignore this error, just update the records
                 pass
             else:
-                stripe_charge = stripe.Charge.retrieve(self.stripe_charge_id)
+                stripe_charge = stripe.Charge.retrieve(self.stripe_charge_id, **get_request_options())
 
                 if stripe_charge.amount_refunded != self.amount_refunded and e.code != "charge_already_refunded":
 
@@ -525,6 +706,41 @@ class StripeCharge(StripeBasicModel):
         stripe_charge_refunded.send(sender=StripeCharge, instance=self)
 
 
+class StripeSubscriptionPlanManager(models.Manager):
+    """
+    Keeps a process-local catalog of plans, which change rarely, so they can be looked up without querying the
+    database. The catalog is reloaded after PLAN_CATALOG_TIMEOUT seconds and cleared when a plan is saved or deleted
+    in the current process, after the transaction is committed.
+
+    Plans returned from the catalog are shared, they should not be modified.
+    """
+
+    # shared by all threads and copies of the manager: (load time, {id: plan})
+    _catalog = (None, {})
+    _catalog_lock = threading.Lock()
+
+    def get_catalog(self):
+        """Returns a dict of all plans by id"""
+        loaded_at, catalog = StripeSubscriptionPlanManager._catalog
+        if loaded_at is None or monotonic() - loaded_at > stripe_settings.PLAN_CATALOG_TIMEOUT:
+            with self._catalog_lock:
+                loaded_at, catalog = StripeSubscriptionPlanManager._catalog
+                if loaded_at is None or monotonic() - loaded_at > stripe_settings.PLAN_CATALOG_TIMEOUT:
+                    catalog = {plan.id: plan for plan in self.get_queryset()}
+                    StripeSubscriptionPlanManager._catalog = (monotonic(), catalog)
+        return catalog
+
+    def get_cached(self, pk):
+        """Returns the plan from the catalog, plans created after the catalog has been loaded are read from database"""
+        plan = self.get_catalog().get(pk)
+        if plan is None:
+            plan = self.get(pk=pk)
+        return plan
+
+    def clear_catalog(self):
+        StripeSubscriptionPlanManager._catalog = (None, {})
+
+
 class StripeSubscriptionPlan(StripeBasicModel):
     INTERVAL_DAY = "day"
     INTERVAL_WEEK = "week"
@@ -578,33 +794,80 @@ class StripeSubscriptionPlan(StripeBasicModel):
         ),
     )
 
+    objects = StripeSubscriptionPlanManager()
+
+    def _stripe_create(self):
+        return stripe.Plan.create(
+            id=self.id,
+            amount=self.amount,
+            currency=self.currency,
+            interval=self.interval,
+            interval_count=self.interval_count,
+            name=self.name,
+            metadata=self.metadata,
+            statement_descriptor=self.statement_descriptor,
+            trial_period_days=self.trial_period_days,
+            **get_request_options(),
+        )
+
     def create_at_stripe(self):
         if self.is_created_at_stripe:
             raise StripeMethodNotAllowed()
 
-        stripe.api_key = stripe_settings.API_KEY
-        try:
-            plan = stripe.Plan.create(
-                id=self.id,
-                amount=self.amount,
-                currency=self.currency,
-                interval=self.interval,
-                interval_count=self.interval_count,
-                name=self.name,
-                metadata=self.metadata,
-                statement_descriptor=self.statement_descriptor,
-                trial_period_days=self.trial_period_days,
-            )
-        except stripe.error.StripeError:
-            self.is_created_at_stripe = False
-            self.save()
-            raise
-
-        self.stripe_response = plan
+        configure_stripe()
+        # nothing is saved if the plan cannot be created, it is still not created at Stripe
+        plan = self._stripe_create()
+        self.stripe_response = self.get_stripe_response(plan)
         self.is_created_at_stripe = True
         self.save()
         return plan
 
+    @classmethod
+    def create_all_at_stripe(cls, workers=None, rate_limit=None):
+        """
+        Create all plans which have not been created at Stripe yet.
+
+        Stripe API is called concurrently, like in StripeSubscription.end_subscriptions(), and the plans are updated
+        in bulk. Returns a list of failures.
+        """
+        configure_stripe()
+
+        def create_at_stripe(plan):
+            try:
+                return plan._stripe_create()
+            except stripe.error.InvalidRequestError as e:
+                if e.code != "resource_already_exists":
+                    raise
+                # created by an interrupted run
+                return stripe.Plan.retrieve(str(plan.id), **get_request_options())
+
+        failures = []
+        created = []
+        now = timezone.now()
+        for plan, stripe_plan, exc_info in run_concurrently(
+                create_at_stripe, list(cls.objects.filter(is_created_at_stripe=False)),
+                workers=workers, rate_limit=rate_limit):
+            if exc_info is not None:
+                logger.error("[AA-Stripe] cannot create plan {}: {}".format(plan.id, exc_info[1]))
+                failures.append({
+                    "obj": plan,
+                    "exc_type": exc_info[0],
+                    "exc_value": exc_info[1],
+                    "exc_traceback": exc_info[2],
+                })
+                continue
+
+            plan.stripe_response = cls.get_stripe_response(stripe_plan)
+            plan.is_created_at_stripe = True
+            plan.updated = now
+            created.append(plan)
+
+        if created:
+            cls.objects.bulk_update(created, ["stripe_response", "is_created_at_stripe", "updated"])
+            # bulk_update does not send post_save signals
+            cls.objects.clear_catalog()
+        return failures
+
 
 class StripeSubscription(StripeBasicModel):
     STATUS_TRIAL = "trialing"
@@ -656,72 +919,341 @@ class StripeSubscription(StripeBasicModel):
     end_date = models.DateField(null=True, blank=True, db_index=True)
     canceled_at = models.DateTimeField(null=True, blank=True, db_index=True)
     at_period_end = models.BooleanField(default=False)
+    stripe_digest = models.CharField(
+        max_length=40, blank=True, editable=False, help_text=_("Digest of Stripe data used in the last update")
+    )
+    stripe_event_created = models.DateTimeField(
+        null=True, blank=True, editable=False,
+        help_text=_("Time of the last Stripe data applied: creation of the webhook event or the Stripe API request"),
+    )
+    current_period_end = models.DateTimeField(
+        null=True, blank=True, db_index=True, editable=False,
+        help_text="https://stripe.com/docs/api/python#subscription_object-current_period_end",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "end_date"], name="aa_stripe_subscription_end"),
+            models.Index(fields=["user", "-created", "-id"], name="aa_stripe_subscription_created"),
+        ]
+
+    @property
+    def end_at(self):
+        """Time when the subscription is due for cancel (None if it has no end date)"""
+        return self.get_end_at(self._meta.get_field("end_date").to_python(self.end_date))
+
+    @classmethod
+    def get_end_at(cls, end_date):
+        """
+        Subscriptions are canceled an hour before the end date begins in the current timezone, so end_subscriptions
+        has a chance to cancel them before they are renewed.
+        """
+        if end_date is None:
+            return None
+        return timezone.make_aware(datetime.combine(end_date, time.min)) - relativedelta(hours=1)
+
+    @classmethod
+    def get_last_due_end_date(cls):
+        """Returns the last end date of subscriptions which are due for cancel now (see get_end_at())"""
+        return timezone.localdate(timezone.now() + relativedelta(hours=1))
 
     def create_at_stripe(self):
         if self.is_created_at_stripe:
             raise StripeMethodNotAllowed()
 
-        stripe.api_key = stripe_settings.API_KEY
+        configure_stripe()
         customer = StripeCustomer.get_latest_active_customer_for_user(self.user)
         if customer:
             data = {
                 "customer": customer.stripe_customer_id,
-                "plan": self.plan.id,
+                "plan": self.plan_id,
                 "metadata": self.metadata,
                 "tax_percent": self.tax_percent,
             }
             if self.coupon:
                 data["coupon"] = self.coupon.coupon_id
 
+            requested_at = timezone.now()
             try:
-                subscription = stripe.Subscription.create(**data)
+                subscription = stripe.Subscription.create(**data, **get_request_options())
             except stripe.error.StripeError:
                 self.is_created_at_stripe = False
                 self.save()
                 raise
 
-            self.set_stripe_data(subscription)
+            self.set_stripe_data(subscription, requested_at=requested_at)
             return subscription
 
-    def set_stripe_data(self, subscription):
+    @classmethod
+    def get_active_subscription_for_user(cls, user):
+        """Returns the latest trialing or active subscription of the user, its plan is taken from the plan catalog"""
+        subscription = cls.objects.filter(user_id=user.id, status__in=[cls.STATUS_TRIAL, cls.STATUS_ACTIVE]).last()
+        if subscription is not None:
+            subscription.plan = StripeSubscriptionPlan.objects.get_cached(subscription.plan_id)
+        return subscription
+
+    @classmethod
+    def get_cached_active_subscription_for_user(cls, user):
+        """Cached get_active_subscription_for_user(), see aa_stripe.cache"""
+        return get_user_value(user.id, "subscription", lambda: cls.get_active_subscription_for_user(user))
+
+    # fields set from stripe.Subscription data by _set_stripe_response()
+    STRIPE_DATA_FIELDS = [
+        "status", "canceled_at", "at_period_end", "current_period_end", "stripe_response", "stripe_digest",
+        "stripe_event_created",
+    ]
+
+    @classmethod
+    def get_data_from_stripe(cls, stripe_subscription):
+        """Returns status, canceled_at, at_period_end and stripe_response converted from stripe.Subscription data"""
+        at_period_end = stripe_subscription.get("cancel_at_period_end") or False
+        canceled_at = stripe_subscription.get("canceled_at")
+        return {
+            # subscriptions canceled at period end are treated as canceled, the same way as in .cancel()
+            "status": cls.STATUS_CANCELED if at_period_end else stripe_subscription["status"],
+            "canceled_at": timestamp_to_timezone_aware_date(canceled_at) if canceled_at else None,
+            "at_period_end": at_period_end,
+            "current_period_end": cls.get_current_period_end(stripe_subscription),
+            "stripe_response": cls.get_stripe_response(stripe_subscription),
+        }
+
+    @classmethod
+    def get_current_period_end(cls, stripe_subscription):
+        current_period_end = stripe_subscription.get("current_period_end")
+        return timestamp_to_timezone_aware_date(current_period_end) if current_period_end else None
+
+    def _set_stripe_response(self, stripe_subscription, requested_at=None):
+        """
+        Set all the fields mapped from stripe.Subscription data by get_data_from_stripe() and its digest.
+        The digest is compared by syncs and webhooks to skip unchanged subscriptions, so it cannot be set without
+        the other fields. Returns the names of the fields which were set.
+
+        requested_at is the time of the Stripe API request which returned the data (defaults to now), it is stored as
+        stripe_event_created, so webhook events created before the request do not overwrite the data.
+        """
+        data = self.get_data_from_stripe(stripe_subscription)
+        data["stripe_digest"] = stripe_digest(stripe_subscription)
+        data["stripe_event_created"] = requested_at or timezone.now()
+        for field, value in data.items():
+            setattr(self, field, value)
+        return list(data)
+
+    def set_stripe_data(self, subscription, requested_at=None):
+        """
+        Update the object with data from stripe.Subscription, the object is saved only if the data has changed.
+        Pass the time of the Stripe API request which returned the data as requested_at (see _set_stripe_response).
+        """
+        digest = stripe_digest(subscription)
+        if self.is_created_at_stripe and digest == self.stripe_digest:
+            return
+
         self.stripe_subscription_id = subscription["id"]
-        # for some reason it doesnt work with subscription only
-        self.stripe_response = json.loads(str(subscription))
+        self._set_stripe_response(subscription, requested_at=requested_at)
         self.is_created_at_stripe = True
-        self.status = subscription["status"]
         self.save()
 
     def refresh_from_stripe(self):
-        stripe.api_key = stripe_settings.API_KEY
-        subscription = stripe.Subscription.retrieve(self.stripe_subscription_id)
-        self.set_stripe_data(subscription)
+        configure_stripe()
+        requested_at = timezone.now()
+        subscription = stripe.Subscription.retrieve(self.stripe_subscription_id, **get_request_options())
+        self.set_stripe_data(subscription, requested_at=requested_at)
         return subscription
 
     def _stripe_cancel(self, at_period_end=False):
-        subscription = self.refresh_from_stripe()
-        if subscription["status"] != "canceled":
-            return subscription.delete(at_period_end=at_period_end)
+        """
+        Cancel the subscription at Stripe with a single API call, without retrieving it first.
+
+        Returns None if the subscription has already been canceled at Stripe.
+        """
+        configure_stripe()
+        try:
+            return stripe.Subscription.delete(
+                self.stripe_subscription_id, at_period_end=at_period_end, **get_request_options())
+        except stripe.error.InvalidRequestError as e:
+            # canceled subscriptions cannot be found in Stripe API anymore
+            if e.code != "resource_missing":
+                raise
+
+            logger.info("[AA-Stripe] subscription {} has already been canceled".format(self.stripe_subscription_id))
+
+    def _set_canceled(self, sub, requested_at=None):
+        """Save the result of _stripe_cancel(), requested at requested_at, with a single write"""
+        update_fields = ["status", "canceled_at", "at_period_end", "updated"]
+        if sub is None:
+            # already canceled at Stripe
+            self.at_period_end = False
+            self.canceled_at = None
+        elif sub["status"] == "canceled" or sub.get("cancel_at_period_end"):
+            update_fields += self._set_stripe_response(sub, requested_at=requested_at)
+        else:
+            return
+
+        self.canceled_at = self.canceled_at or timezone.now()
+        self.status = self.STATUS_CANCELED
+        self.save(update_fields=list(dict.fromkeys(update_fields)))
 
     def cancel(self, at_period_end=False):
+        # the local status is kept up to date by the refresh_subscriptions command,
+        # so the subscription does not have to be retrieved from Stripe before canceling
+        if self.status == self.STATUS_CANCELED:
+            return
+
+        requested_at = timezone.now()
         sub = self._stripe_cancel(at_period_end=at_period_end)
-        if sub and sub["status"] == "canceled" or sub["cancel_at_period_end"]:
-            self.canceled_at = timezone.now()
-            self.status = self.STATUS_CANCELED
-            self.at_period_end = at_period_end
-            self.save()
+        self._set_canceled(sub, requested_at=requested_at)
 
     @classmethod
     def get_subcriptions_for_cancel(cls):
-        today = timezone.localtime(timezone.now() + relativedelta(hours=1)).date()
-        return cls.objects.filter(end_date__lte=today, status=cls.STATUS_ACTIVE)
+        return cls.objects.filter(end_date__lte=cls.get_last_due_end_date(), status=cls.STATUS_ACTIVE)
+
+    @classmethod
+    def get_next_end_at(cls):
+        """Returns the time when the next active subscription will be due for cancel (None if there are none)"""
+        return cls.get_end_at(cls.objects.filter(
+            end_date__gt=cls.get_last_due_end_date(), status=cls.STATUS_ACTIVE
+        ).aggregate(end_date=models.Min("end_date"))["end_date"])
+
+    @classmethod
+    def forecast(cls, days=30):
+        """
+        Returns the expected number of renewals and cancels of subscriptions for each of the next days (starting
+        today), as a list of dicts with date, renewals and cancels keys.
+
+        Renewals are counted from current_period_end of subscriptions which will not be canceled before that time,
+        cancels from end_date (see end_subscriptions()). Both fields are indexed. Further renewals within the
+        forecast (for example of daily or weekly plans) are projected from the interval of the plan, until the end
+        date of the subscription. Changes of the plans, trials ending and failed payments are not projected.
+        """
+        today = timezone.localdate()
+        start = timezone.make_aware(datetime.combine(today, time.min))
+        end = timezone.make_aware(datetime.combine(today + relativedelta(days=days), time.min))
+        renewals = {}
+        periods = cls.objects.filter(
+            current_period_end__gte=start, current_period_end__lt=end,
+            status__in=[cls.STATUS_TRIAL, cls.STATUS_ACTIVE, cls.STATUS_PAST_DUE], at_period_end=False,
+        ).exclude(end_date__lte=TruncDate(
+            models.ExpressionWrapper(
+                models.F("current_period_end") + timedelta(hours=1), output_field=models.DateTimeField()
+            ),
+            tzinfo=timezone.get_current_timezone(),
+        )).annotate(
+            date=TruncDate("current_period_end", tzinfo=timezone.get_current_timezone())
+        ).order_by().values("date", "plan__interval", "plan__interval_count", "end_date").annotate(
+            count=models.Count("id")
+        ).values_list("date", "plan__interval", "plan__interval_count", "end_date", "count")
+        for first_date, interval, interval_count, end_date, count in periods:
+            date = first_date
+            renewal = 0
+            # subscriptions are canceled before they are renewed on the end date (see get_end_at())
+            while date < today + relativedelta(days=days) and (renewal == 0 or not end_date or date < end_date):
+                renewals[date] = renewals.get(date, 0) + count
+                renewal += 1
+                date = first_date + relativedelta(**{"{}s".format(interval): interval_count * renewal})
+        # subscriptions are due for cancel on the day before the end date (see get_end_at())
+        cancels = {end_date - relativedelta(days=1): count for end_date, count in cls.objects.filter(
+            end_date__gt=today, end_date__lte=today + relativedelta(days=days), status=cls.STATUS_ACTIVE
+        ).order_by().values("end_date").annotate(count=models.Count("id")).values_list("end_date", "count")}
+
+        forecast = []
+        for day in range(days):
+            date = today + relativedelta(days=day)
+            forecast.append({"date": date, "renewals": renewals.get(date, 0), "cancels": cancels.get(date, 0)})
+        return forecast
+
+    @classmethod
+    def end_subscriptions(cls, at_period_end=False, workers=None, rate_limit=None):
+        """
+        Cancel all subscriptions which have passed end date.
+
+        Stripe API is called concurrently (see the WORKERS and API_RATE_LIMIT settings) and a failure does not stop
+        canceling other subscriptions. Returns a list of failures, dicts with obj, exc_type, exc_value and
+        exc_traceback keys.
+        """
+        failures = []
+        requested_at = timezone.now()
+        results = run_concurrently(
+            lambda subscription: subscription._stripe_cancel(at_period_end=at_period_end),
+            list(cls.get_subcriptions_for_cancel()), workers=workers, rate_limit=rate_limit
+        )
+        for subscription, sub, exc_info in results:
+            if exc_info is None:
+                try:
+                    subscription._set_canceled(sub, requested_at=requested_at)
+                    continue
+                except Exception:
+                    exc_info = sys.exc_info()
+
+            logger.error("[AA-Stripe] cannot cancel subscription {}: {}".format(subscription.id, exc_info[1]))
+            failures.append({
+                "obj": subscription,
+                "exc_type": exc_info[0],
+                "exc_value": exc_info[1],
+                "exc_traceback": exc_info[2],
+            })
+        return failures
 
     @classmethod
-    def end_subscriptions(cls, at_period_end=False):
-        # do not use in cron - one broken subscription will exit script.
-        # Instead please use end_subscriptions.py script.
-        for subscription in cls.get_subcriptions_for_cancel():
-            subscription.cancel(at_period_end)
-            sleep(0.25)  # 4 requests per second tops
+    def get_subscriptions_to_migrate(cls, from_plan, statuses=None):
+        """Returns subscriptions created at Stripe on the plan with given statuses (default: all but canceled)"""
+        queryset = cls.objects.filter(plan=from_plan, is_created_at_stripe=True)
+        if statuses:
+            return queryset.filter(status__in=statuses)
+        return queryset.exclude(status=cls.STATUS_CANCELED)
+
+    @classmethod
+    def migrate_plan(cls, from_plan, to_plan, statuses=None, prorate=True, batch_size=100, workers=None,
+                     rate_limit=None, token=None):
+        """
+        Move subscriptions created at Stripe from one plan to another.
+
+        Only subscriptions with given statuses are moved (default: all but canceled). Stripe API is called
+        concurrently, like in end_subscriptions(), and the local objects are updated in bulk after each batch.
+        The requests use idempotency keys made of the token identifying the migration (a random one by default)
+        and the migrated subscriptions are not selected again, so an interrupted migration can be resumed by calling
+        the method again with the same token. Returns a list of failures.
+        """
+        configure_stripe()
+        queryset = cls.get_subscriptions_to_migrate(from_plan, statuses=statuses).order_by("pk")
+        token = token or uuid4().hex
+
+        def update_at_stripe(subscription):
+            return stripe.Subscription.modify(
+                subscription.stripe_subscription_id,
+                plan=to_plan.id,
+                prorate=prorate,
+                idempotency_key="aa-stripe-migrate-plan-{}-{}".format(token, subscription.stripe_subscription_id),
+                **get_request_options(),
+            )
+
+        failures = []
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return failures
+
+            last_pk = batch[-1].pk
+            migrated = []
+            now = timezone.now()
+            for subscription, sub, exc_info in run_concurrently(
+                    update_at_stripe, batch, workers=workers, rate_limit=rate_limit):
+                if exc_info is not None:
+                    logger.error("[AA-Stripe] cannot migrate subscription {}: {}".format(subscription.id, exc_info[1]))
+                    failures.append({
+                        "obj": subscription,
+                        "exc_type": exc_info[0],
+                        "exc_value": exc_info[1],
+                        "exc_traceback": exc_info[2],
+                    })
+                    continue
+
+                subscription.plan = to_plan
+                subscription._set_stripe_response(sub, requested_at=now)
+                subscription.updated = now
+                migrated.append(subscription)
+
+            cls.objects.bulk_update(migrated, ["plan", "updated"] + cls.STRIPE_DATA_FIELDS)
+            invalidate_users(subscription.user_id for subscription in migrated)
 
 
 class StripeWebhook(models.Model):
@@ -732,6 +1264,10 @@ class StripeWebhook(models.Model):
     raw_data = JSONField(blank=True)
     parse_error = models.TextField(blank=True)
 
+    DEFERRED_FIELDS = ["raw_data"]
+
+    objects = StripeManager()
+
     def _parse_coupon_notification(self, action):
         coupon_id = self.raw_data["data"]["object"]["id"]
         created = timestamp_to_timezone_aware_date(self.raw_data["data"]["object"]["created"])
@@ -750,10 +1286,16 @@ class StripeWebhook(models.Model):
         elif action == "updated":
             try:
                 coupon = StripeCoupon.objects.get(coupon_id=coupon_id, created=created)
-                coupon.metadata = self.raw_data["data"]["object"]["metadata"]
-                super(StripeCoupon, coupon).save()  # use the super method not to call Stripe API
             except StripeCoupon.DoesNotExist:
-                pass  # do not update if does not exist
+                return  # do not update if does not exist
+
+            digest = stripe_digest(self.raw_data["data"]["object"])
+            if coupon.stripe_digest != digest:
+                # all the fields have to be updated with the digest, syncs skip coupons with the same digest
+                coupon.update_from_stripe_data(self.raw_data["data"]["object"], commit=False)
+                coupon.stripe_response = coupon.get_stripe_response(self.raw_data["data"]["object"])
+                coupon.stripe_digest = digest
+                super(StripeCoupon, coupon).save()  # use the super method not to call Stripe API
         elif action == "deleted":
             StripeCoupon.objects.filter(coupon_id=coupon_id, created=created).delete()
 
@@ -770,6 +1312,25 @@ class StripeWebhook(models.Model):
             except (StripeCustomer.DoesNotExist, stripe.error.StripeError) as e:
                 logger.warning("[AA-Stripe] cannot parse customer.updated webhook: {}".format(e))
 
+    def _parse_subscription_notification(self, action):
+        """Update the subscription with data from the event, without calling Stripe API"""
+        stripe_subscription = self.raw_data["data"]["object"]
+        event_created = timestamp_to_timezone_aware_date(self.raw_data["created"])
+        data = StripeSubscription.get_data_from_stripe(stripe_subscription)
+        data["stripe_digest"] = stripe_digest(stripe_subscription)
+        # events can be delivered out of order, older events must not overwrite data from the newer ones
+        updated = StripeSubscription.objects.filter(
+            models.Q(stripe_event_created__isnull=True) | models.Q(stripe_event_created__lte=event_created),
+            stripe_subscription_id=stripe_subscription["id"],
+        ).exclude(stripe_digest=data["stripe_digest"]).update(
+            stripe_event_created=event_created, updated=timezone.now(), **data)
+        if updated:
+            invalidate_users(StripeSubscription.objects.filter(
+                stripe_subscription_id=stripe_subscription["id"]).values_list("user_id", flat=True))
+        else:
+            logger.info("[AA-Stripe] subscription {} not updated by {} webhook".format(
+                stripe_subscription["id"], self.id))
+
     def _parse_dispute_notification(self, action):
         logger.info("[AA-Stripe] New dispute for charge {}".format(self.raw_data["data"]["object"]["charge"]))
 
@@ -791,14 +1352,17 @@ class StripeWebhook(models.Model):
             event_action=event_action,
         )
 
-        # parse
+        # parse, events of Connect accounts are parsed in the context of the account
         if event_model:
-            if event_model == "coupon":
-                self._parse_coupon_notification(event_action)
-            elif event_model in ["customer", "customer.source"]:
-                self._parse_customer_notification(event_model, event_action)
-            elif event_model == "charge.dispute":
-                self._parse_dispute_notification(event_action)
+            with stripe_account_context(stripe_account=self.raw_data.get("account")):
+                if event_model == "coupon":
+                    self._parse_coupon_notification(event_action)
+                elif event_model in ["customer", "customer.source"]:
+                    self._parse_customer_notification(event_model, event_action)
+                elif event_model == "customer.subscription":
+                    self._parse_subscription_notification(event_action)
+                elif event_model == "charge.dispute":
+                    self._parse_dispute_notification(event_action)
 
         self.is_parsed = True
         if save:
@@ -815,3 +1379,29 @@ class StripeWebhook(models.Model):
 
     class Meta:
         ordering = ["-created"]
+
+
+@receiver(post_save, sender=StripeCustomer)
+@receiver(post_delete, sender=StripeCustomer)
+@receiver(post_save, sender=StripeSubscription)
+@receiver(post_delete, sender=StripeSubscription)
+def invalidate_user_cache(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=StripeCoupon)
+@receiver(post_delete, sender=StripeCoupon)
+def invalidate_coupon_cache(sender, instance, **kwargs):
+    invalidate_coupons([instance.coupon_id])
+
+
+@receiver(stripe_coupons_deleted, sender=StripeCoupon)
+def invalidate_deleted_coupons_cache(sender, pks, **kwargs):
+    invalidate_coupons(StripeCoupon.objects.all_with_deleted().filter(pk__in=pks).values_list("coupon_id", flat=True))
+
+
+@receiver(post_save, sender=StripeSubscriptionPlan)
+@receiver(post_delete, sender=StripeSubscriptionPlan)
+def clear_plan_catalog(sender, instance, **kwargs):
+    # cleared after the commit, otherwise other threads could load the old plans again before it
+    transaction.on_commit(StripeSubscriptionPlan.objects.clear_catalog)
@@ -7,7 +7,7 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.serializers import JSONField, ModelSerializer
 
-from aa_stripe.models import StripeCoupon, StripeCustomer, StripeWebhook
+from aa_stripe.models import StripeCharge, StripeCoupon, StripeCustomer, StripeSubscription, StripeWebhook
 
 logging.getLogger("aa-stripe")
 
@@ -22,6 +22,22 @@ class StripeCouponSerializer(ModelSerializer):
         ]
 
 
+class StripeCouponValidationSerializer(ModelSerializer):
+    valid = serializers.BooleanField(source="is_redeemable")
+
+    class Meta:
+        model = StripeCoupon
+        fields = [
+            "coupon_id", "valid", "redeem_by", "max_redemptions", "times_redeemed", "amount_off", "percent_off",
+            "currency", "duration", "duration_in_months"
+        ]
+
+
+class StripeCouponsValidationSerializer(serializers.Serializer):
+    coupon_ids = serializers.ListField(
+        child=serializers.CharField(max_length=255), allow_empty=False, max_length=100)
+
+
 class StripeCustomerSerializer(ModelSerializer):
     stripe_js_response = JSONField()
 
@@ -86,6 +102,30 @@ class StripeCustomerDetailsSerializer(ModelSerializer):
         read_only_fields = ["id", "user", "stripe_customer_id", "is_active", "sources", "default_source"]
 
 
+class StripeCustomerListSerializer(ModelSerializer):
+    class Meta:
+        model = StripeCustomer
+        fields = ["id", "stripe_customer_id", "is_active", "default_source", "default_source_data", "created"]
+
+
+class StripeChargeSerializer(ModelSerializer):
+    class Meta:
+        model = StripeCharge
+        fields = [
+            "id", "stripe_charge_id", "amount", "amount_refunded", "is_charged", "is_refunded", "charge_attempt_failed",
+            "description", "created"
+        ]
+
+
+class StripeSubscriptionSerializer(ModelSerializer):
+    class Meta:
+        model = StripeSubscription
+        fields = [
+            "id", "stripe_subscription_id", "plan", "status", "end_date", "canceled_at", "at_period_end",
+            "current_period_end", "created"
+        ]
+
+
 class StripeWebhookSerializer(ModelSerializer):
 
     class Meta:
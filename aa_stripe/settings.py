@@ -22,6 +22,27 @@ DEFAULTS = {
     "API_KEY": "",
     "WEBHOOK_ENDPOINT_SECRET": "",
     "USER_MODEL": settings.AUTH_USER_MODEL,
+    # number of threads used to call Stripe API concurrently, for example in the end_subscriptions command
+    "WORKERS": 4,
+    # maximum number of Stripe API calls per second made by concurrent operations
+    "API_RATE_LIMIT": 20,
+    # cache used by the cached lookups (see aa_stripe.cache) and the timeout of the values in seconds
+    "CACHE_ALIAS": "default",
+    "CACHE_TIMEOUT": 60 * 60,
+    # number of seconds after which the process-local catalog of plans is reloaded
+    "PLAN_CATALOG_TIMEOUT": 5 * 60,
+    # fields dropped from stripe_response by Stripe object type, for example: {"subscription": ["items"]}
+    "RESPONSE_EXCLUDE_FIELDS": {},
+    # Stripe API client (see aa_stripe.client): maximum number of kept-alive connections, timeouts in seconds,
+    # number of retries of requests which failed because of network errors (None not to change stripe-python setting)
+    # and opening a connection in advance
+    "HTTP_POOL_SIZE": 10,
+    "HTTP_CONNECT_TIMEOUT": 10,
+    "HTTP_READ_TIMEOUT": 80,
+    "MAX_NETWORK_RETRIES": None,
+    "HTTP_WARM_UP": False,
+    # number of seconds the responses of the coupon and customer details APIs are cached for, 0 to disable the cache
+    "API_CACHE_TIMEOUT": 0,
 }
 
 PAYMENT_ORIGIN = (
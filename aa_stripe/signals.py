@@ -4,3 +4,4 @@ import django.dispatch
 stripe_charge_succeeded = django.dispatch.Signal()
 stripe_charge_card_exception = django.dispatch.Signal()
 stripe_charge_refunded = django.dispatch.Signal()
+stripe_coupons_deleted = django.dispatch.Signal()
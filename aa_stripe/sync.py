@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Generic engine which mirrors Stripe list resources onto local models.
+
+A sync is described by subclassing StripeSync, for example:
+
+class CustomerSync(StripeSync):
+    resource = stripe.Customer
+    model = StripeCustomer
+    lookup_field = "stripe_customer_id"
+    fields = ["sources", "default_source"]
+    digest_field = "stripe_digest"
+
+    def map_object(self, stripe_customer):
+        return {"sources": stripe_customer["sources"]["data"], "default_source": stripe_customer["default_source"]}
+
+CustomerSync(dry_run=True).run()  # returns a dict with sync metrics
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from uuid import uuid4
+
+import stripe
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.utils import dateformat, timezone
+
+from aa_stripe.cache import invalidate_coupons, invalidate_users
+from aa_stripe.client import configure_stripe, get_request_options
+from aa_stripe.models import StripeCharge, StripeCoupon, StripeCustomer, StripeSubscription, StripeSubscriptionPlan
+from aa_stripe.utils import stripe_digest, timestamp_to_timezone_aware_date
+
+logger = logging.getLogger("aa-stripe")
+
+
+class StripeSync(object):
+    resource = None  # Stripe API resource with the list() method, for example stripe.Customer
+    model = None
+    lookup_field = None  # local field matched against the "id" of Stripe objects
+    fields = []  # local fields written by the sync, map_object() must return values for them
+    # field storing the digest of Stripe data, if set only objects with a different digest are mapped and written
+    digest_field = None
+    # set for models with the user field to invalidate the cached lookups of users (see aa_stripe.cache)
+    invalidate_user_cache = False
+    page_size = 100  # 100 is the maximum
+    max_retries = 5
+
+    def __init__(self, dry_run=False, starting_after=None, list_params=None):
+        self.dry_run = dry_run
+        self.list_params = list_params or {}
+        self.resumed = starting_after is not None
+        # id of the last Stripe object which has been processed, pass it as starting_after to resume the sync
+        self.checkpoint = starting_after
+        # time of the Stripe API request which returned the page being synced
+        self.page_requested_at = None
+        # API key and Stripe account of the current context, pages are fetched by another thread which does not see it
+        self.request_options = get_request_options()
+        self.stats = {
+            "pages": 0,
+            "fetched": 0,
+            "created": 0,
+            "updated": 0,
+            "unchanged": 0,
+            "missing": 0,
+            "errors": 0,
+            "duration": 0,
+        }
+
+    def get_queryset(self):
+        return self.model._default_manager.all()
+
+    def get_key(self, stripe_object):
+        """Returns the key used to match the Stripe object with local objects, None to skip the Stripe object"""
+        return stripe_object["id"]
+
+    def get_instance_key(self, instance):
+        return getattr(instance, self.lookup_field)
+
+    def get_existing(self, keys):
+        """Returns local objects matching given keys as a dict of lists (there might be more than one object per key)"""
+        existing = {}
+        queryset = self.get_queryset().filter(**{"{}__in".format(self.lookup_field): keys}).order_by()
+        for instance in queryset:
+            existing.setdefault(self.get_instance_key(instance), []).append(instance)
+        return existing
+
+    def map_object(self, stripe_object):
+        """Returns values of local fields for the Stripe object"""
+        return {field: stripe_object[field] for field in self.fields}
+
+    def new_instance(self, stripe_object, data):
+        """Returns an unsaved object for a Stripe object which does not exist locally, or None to skip it"""
+        return None
+
+    def has_changed(self, instance, data):
+        return any(getattr(instance, field) != value for field, value in data.items())
+
+    def get_update_fields(self):
+        update_fields = list(self.fields)
+        if self.digest_field:
+            update_fields.append(self.digest_field)
+        # auto_now is not applied by bulk_update
+        if "updated" not in update_fields and any(field.name == "updated" for field in self.model._meta.fields):
+            update_fields.append("updated")
+        return update_fields
+
+    def update(self, instances):
+        now = timezone.now()
+        for instance in instances:
+            instance.updated = now
+        self.model._default_manager.bulk_update(instances, self.get_update_fields())
+        if self.invalidate_user_cache:
+            # bulk_update does not send post_save signals
+            invalidate_users(instance.user_id for instance in instances)
+
+    def create(self, instances):
+        self.model._default_manager.bulk_create(instances)
+
+    def fetch_page(self, starting_after):
+        """Returns the page of Stripe objects and the time of the request which returned it"""
+        retry_count = 0
+        while True:
+            requested_at = timezone.now()
+            try:
+                return requested_at, self.resource.list(
+                    limit=self.page_size, starting_after=starting_after, **self.list_params, **self.request_options)
+            except stripe.error.StripeError:
+                if retry_count >= self.max_retries:
+                    raise
+                retry_count += 1
+
+    def iter_pages(self):
+        """
+        Yields pages of Stripe objects with the time they were requested at, the next page is fetched while the current
+        one is being processed
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.fetch_page, self.checkpoint)
+            while future:
+                requested_at, page = future.result()
+                future = None
+                if page["has_more"] and page["data"]:
+                    future = executor.submit(self.fetch_page, page["data"][-1]["id"])
+                yield requested_at, page
+
+    def sync_page(self, stripe_objects):
+        keyed_objects = []
+        for stripe_object in stripe_objects:
+            try:
+                key = self.get_key(stripe_object)
+            except Exception as e:
+                self.log_error(stripe_object, e)
+                continue
+
+            if key is None:
+                self.stats["missing"] += 1
+            else:
+                keyed_objects.append((stripe_object, key))
+
+        existing = self.get_existing([key for stripe_object, key in keyed_objects])
+        to_update = []
+        to_create = []
+        for stripe_object, key in keyed_objects:
+            instances = existing.get(key, [])
+            digest = None
+            if self.digest_field:
+                # compare digests first, so unchanged objects do not even have to be mapped
+                digest = stripe_digest(stripe_object)
+                changed_instances = [
+                    instance for instance in instances if getattr(instance, self.digest_field) != digest
+                ]
+                self.stats["unchanged"] += len(instances) - len(changed_instances)
+                if instances and not changed_instances:
+                    continue
+                instances = changed_instances
+
+            try:
+                data = self.map_object(stripe_object)
+            except Exception as e:
+                self.log_error(stripe_object, e)
+                continue
+
+            if digest:
+                data[self.digest_field] = digest
+
+            if key not in existing:
+                instance = self.new_instance(stripe_object, data)
+                if instance is None:
+                    self.stats["missing"] += 1
+                else:
+                    to_create.append(instance)
+                continue
+
+            for instance in instances:
+                if not digest and not self.has_changed(instance, data):
+                    self.stats["unchanged"] += 1
+                    continue
+
+                for field, value in data.items():
+                    setattr(instance, field, value)
+                to_update.append(instance)
+
+        if not self.dry_run and (to_update or to_create):
+            with transaction.atomic():
+                if to_update:
+                    self.update(to_update)
+                if to_create:
+                    self.create(to_create)
+        self.stats["updated"] += len(to_update)
+        self.stats["created"] += len(to_create)
+
+    def log_error(self, stripe_object, error):
+        self.stats["errors"] += 1
+        logger.warning("[AA-Stripe] cannot sync {} {}: {}".format(
+            self.model._meta.object_name, stripe_object.get("id"), error))
+
+    def finish(self):
+        """Called after all pages were synced"""
+
+    def run(self):
+        configure_stripe()
+        start_time = time()
+        for self.page_requested_at, page in self.iter_pages():
+            self.stats["pages"] += 1
+            self.stats["fetched"] += len(page["data"])
+            self.sync_page(page["data"])
+            if page["data"]:
+                self.checkpoint = page["data"][-1]["id"]
+
+        self.finish()
+        self.stats["duration"] = time() - start_time
+        return self.stats
+
+
+class CustomerSync(StripeSync):
+    resource = stripe.Customer
+    model = StripeCustomer
+    lookup_field = "stripe_customer_id"
+    fields = ["sources", "default_source"]
+    digest_field = "stripe_digest"
+    invalidate_user_cache = True
+
+    def map_object(self, stripe_customer):
+        return {
+            "sources": stripe_customer["sources"]["data"],
+            "default_source": stripe_customer["default_source"] or "",
+        }
+
+
+class CouponSync(StripeSync):
+    """
+    Coupons are matched by coupon_id and the creation date, because a coupon_id can be reused after deleting a coupon.
+
+    Coupons which do not exist locally are created and, after a full sync without errors, coupons which do not exist at
+    Stripe anymore are marked as deleted. Coupons found at Stripe are stamped with the token of the sync, so the stale
+    ones are selected by the database.
+    """
+
+    resource = stripe.Coupon
+    model = StripeCoupon
+    lookup_field = "coupon_id"
+    fields = sorted(StripeCoupon.STRIPE_FIELDS)
+    digest_field = "stripe_digest"
+    delete_batch_size = 500  # number of coupons marked as deleted with a single UPDATE query
+
+    def __init__(self, *args, **kwargs):
+        super(CouponSync, self).__init__(*args, **kwargs)
+        self.stats["deleted"] = 0
+        # coupons are only stamped by full syncs, which can mark the other coupons as deleted
+        self.sync_token = uuid4().hex if not (self.dry_run or self.resumed) else None
+
+    def get_key(self, stripe_coupon):
+        return stripe_coupon["id"], timestamp_to_timezone_aware_date(stripe_coupon["created"])
+
+    def get_instance_key(self, coupon):
+        return coupon.coupon_id, coupon.created
+
+    def get_existing(self, keys):
+        keys = set(keys)
+        existing = {}
+        queryset = self.get_queryset().filter(coupon_id__in=[coupon_id for coupon_id, created in keys]).order_by()
+        for coupon in queryset:
+            key = self.get_instance_key(coupon)
+            if key in keys:
+                existing.setdefault(key, []).append(coupon)
+
+        if self.sync_token and existing:
+            # indicate which coupons should have is_deleted=False
+            StripeCoupon.objects.filter(
+                pk__in=[coupon.pk for coupons in existing.values() for coupon in coupons]
+            ).update(sync_token=self.sync_token)
+        return existing
+
+    def map_object(self, stripe_coupon):
+        return StripeCoupon.get_data_from_stripe(stripe_coupon)
+
+    def update(self, coupons):
+        super(CouponSync, self).update(coupons)
+        # bulk_update does not send post_save signals
+        invalidate_coupons(coupon.coupon_id for coupon in coupons)
+
+    def new_instance(self, stripe_coupon, data):
+        # already have the data - we do not need to call Stripe API again
+        return StripeCoupon(coupon_id=stripe_coupon["id"], **data)
+
+    def create(self, coupons):
+        for coupon in coupons:
+            coupon.sync_token = self.sync_token or ""
+            super(StripeCoupon, coupon).save()
+
+    def finish(self):
+        # coupons can be marked as deleted only if all of them were fetched from Stripe, coupons which could not be
+        # synced because of errors would be marked as deleted as well
+        if not self.sync_token or self.stats["errors"]:
+            return
+
+        # update can be used here, because those coupons does not exist in the Stripe API anymore,
+        # marked coupons are not selected again
+        stale_coupons = StripeCoupon.objects.exclude(sync_token=self.sync_token).order_by("pk").values_list(
+            "pk", flat=True)
+        while True:
+            stale_coupons_ids = list(stale_coupons[:self.delete_batch_size])
+            if not stale_coupons_ids:
+                return
+            self.stats["deleted"] += StripeCoupon.objects.mark_deleted(stale_coupons_ids)
+
+
+class PlanSync(StripeSync):
+    """
+    Plans are created at Stripe with the local primary key as the id, plans with other ids are skipped.
+    Plans created in Stripe dashboard with numeric ids are created locally.
+    """
+
+    resource = stripe.Plan
+    model = StripeSubscriptionPlan
+    lookup_field = "id"
+    fields = [
+        "amount", "currency", "interval", "interval_count", "name", "metadata", "statement_descriptor",
+        "trial_period_days", "is_created_at_stripe", "stripe_response",
+    ]
+
+    def get_key(self, stripe_plan):
+        plan_id = str(stripe_plan["id"])
+        return int(plan_id) if plan_id.isdigit() else None
+
+    def map_object(self, stripe_plan):
+        return {
+            "amount": stripe_plan["amount"],
+            "currency": stripe_plan["currency"].upper(),
+            "interval": stripe_plan["interval"],
+            "interval_count": stripe_plan["interval_count"],
+            "name": stripe_plan.get("name") or stripe_plan.get("nickname") or "",
+            "metadata": stripe_plan["metadata"],
+            "statement_descriptor": stripe_plan.get("statement_descriptor") or "",
+            "trial_period_days": stripe_plan.get("trial_period_days") or 0,
+            "is_created_at_stripe": True,
+            "stripe_response": StripeSubscriptionPlan.get_stripe_response(stripe_plan),
+        }
+
+    def new_instance(self, stripe_plan, data):
+        return StripeSubscriptionPlan(id=self.get_key(stripe_plan), **data)
+
+    def update(self, instances):
+        super(PlanSync, self).update(instances)
+        # bulk_update does not send post_save signals
+        transaction.on_commit(StripeSubscriptionPlan.objects.clear_catalog)
+
+    def create(self, instances):
+        super(PlanSync, self).create(instances)
+        transaction.on_commit(StripeSubscriptionPlan.objects.clear_catalog)
+
+    def finish(self):
+        if self.stats["created"] and not self.dry_run:
+            # the plans were created with explicit ids, make sure the next ids generated by the database are not taken
+            connection = connections[router.db_for_write(StripeSubscriptionPlan)]
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [StripeSubscriptionPlan]):
+                    cursor.execute(sql)
+
+
+class SubscriptionSync(StripeSync):
+    resource = stripe.Subscription
+    model = StripeSubscription
+    lookup_field = "stripe_subscription_id"
+    # stripe_event_created is set to the time of the request, so older webhook events do not overwrite synced data
+    fields = ["status", "canceled_at", "at_period_end", "current_period_end", "stripe_response", "stripe_event_created"]
+    digest_field = "stripe_digest"
+    invalidate_user_cache = True
+
+    def __init__(self, status=None, **kwargs):
+        super(SubscriptionSync, self).__init__(**kwargs)
+        if status:
+            # Stripe returns all subscriptions except canceled ones by default, use "all" to include them
+            self.list_params["status"] = status
+
+    def map_object(self, stripe_subscription):
+        data = StripeSubscription.get_data_from_stripe(stripe_subscription)
+        data["stripe_event_created"] = self.page_requested_at
+        return data
+
+
+class ChargeSync(StripeSync):
+    resource = stripe.Charge
+    model = StripeCharge
+    lookup_field = "stripe_charge_id"
+    fields = ["is_charged", "amount_refunded", "is_refunded"]
+
+    def map_object(self, stripe_charge):
+        return {
+            "is_charged": stripe_charge["paid"],
+            "amount_refunded": stripe_charge["amount_refunded"],
+            "is_refunded": stripe_charge["refunded"],
+        }
+
+
+class ChargeReconcileSync(ChargeSync):
+    """Syncs charges created in the given time window and collects metrics of the differences found"""
+
+    def __init__(self, created_after=None, created_before=None, **kwargs):
+        super(ChargeReconcileSync, self).__init__(**kwargs)
+        created = {}
+        if created_after:
+            created["gte"] = int(dateformat.format(created_after, "U"))
+        if created_before:
+            created["lt"] = int(dateformat.format(created_before, "U"))
+        if created:
+            self.list_params["created"] = created
+
+        self.stats.update({"{}_drift".format(field): 0 for field in self.fields})
+        self.stats.update({"refunded_amount_drift": 0, "disputed": 0})
+
+    def sync_page(self, stripe_charges):
+        self.disputed_keys = {self.get_key(charge) for charge in stripe_charges if charge.get("disputed")}
+        return super(ChargeReconcileSync, self).sync_page(stripe_charges)
+
+    def get_existing(self, keys):
+        existing = super(ChargeReconcileSync, self).get_existing(keys)
+        # only disputes of charges which exist locally are counted
+        self.stats["disputed"] += len(self.disputed_keys.intersection(existing))
+        return existing
+
+    def has_changed(self, charge, data):
+        drift = {field: value for field, value in data.items() if getattr(charge, field) != value}
+        for field in drift:
+            self.stats["{}_drift".format(field)] += 1
+        if "amount_refunded" in drift:
+            self.stats["refunded_amount_drift"] += drift["amount_refunded"] - (charge.amount_refunded or 0)
+        if drift:
+            logger.info("[AA-Stripe] charge {} differs from Stripe: {}".format(
+                charge.stripe_charge_id, ", ".join(
+                    "{}: {} -> {}".format(field, getattr(charge, field), value) for field, value in drift.items())))
+        return bool(drift)
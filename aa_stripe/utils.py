@@ -1,7 +1,83 @@
+import hashlib
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
 from datetime import datetime
+from time import monotonic, sleep
 
+import simplejson as json
+from django.db import connections
 from django.utils import timezone
 
+from aa_stripe.settings import stripe_settings
+
 
 def timestamp_to_timezone_aware_date(timestamp):
     return timezone.make_aware(datetime.fromtimestamp(timestamp))
+
+
+def stripe_digest(data):
+    """Returns a digest of Stripe object data, used to check if the object has changed since the last update"""
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def to_dict(stripe_object, exclude_fields=None):
+    """
+    Converts a StripeObject to plain dicts and lists in a single pass, without serializing it to JSON and back.
+    Top-level fields listed in exclude_fields are dropped.
+    """
+    exclude_fields = exclude_fields or ()
+    return {key: _to_python(value) for key, value in stripe_object.items() if key not in exclude_fields}
+
+
+def _to_python(value):
+    if isinstance(value, dict):
+        return {key: _to_python(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_python(item) for item in value]
+    return value
+
+
+class RateLimiter(object):
+    """Spaces calls to wait() so that no more than rate calls per second are made, can be shared between threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_call = 0
+
+    def wait(self):
+        with self._lock:
+            now = monotonic()
+            delay = max(0, self._next_call - now)
+            self._next_call = max(now, self._next_call) + self.interval
+
+        if delay:
+            sleep(delay)
+
+
+def run_concurrently(func, items, workers=None, rate_limit=None):
+    """
+    Call func for each item using a pool of threads, starting no more than rate_limit calls per second.
+
+    Yields (item, result, exc_info) tuples as the calls complete, exc_info is None if the call succeeded.
+    Database writes should be done by the caller with the yielded results.
+    """
+    rate_limiter = RateLimiter(rate_limit or stripe_settings.API_RATE_LIMIT)
+
+    def call(item):
+        rate_limiter.wait()
+        try:
+            return func(item), None
+        except Exception:
+            return None, sys.exc_info()
+        finally:
+            connections.close_all()  # connections are opened per thread
+
+    with ThreadPoolExecutor(max_workers=workers or stripe_settings.WORKERS) as executor:
+        # context variables (for example the Stripe account, see aa_stripe.client) are passed to the threads
+        futures = {executor.submit(copy_context().run, call, item): item for item in items}
+        for future in as_completed(futures):
+            result, exc_info = future.result()
+            yield futures[future], result, exc_info
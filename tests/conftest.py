@@ -28,5 +28,6 @@ def pytest_configure():
         TESTING=True,
         ENV_PREFIX="test-env",
         STRIPE_SETTINGS_API_KEY="apikey",
+        STRIPE_API_KEY="sk_test_apikey",
         STRIPE_SETTINGS_WEBHOOK_ENDPOINT_SECRET="fake",
     )
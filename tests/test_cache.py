@@ -0,0 +1,125 @@
+import requests_mock
+import simplejson as json
+from django.core.cache import cache
+from rest_framework.reverse import reverse
+
+from aa_stripe.models import StripeCoupon, StripeCustomer, StripeSubscription, StripeSubscriptionPlan
+from aa_stripe.sync import CouponSync, CustomerSync
+from tests.test_utils import BaseTestCase
+
+
+class TestCache(BaseTestCase):
+    def setUp(self):
+        cache.clear()
+        self._create_user()
+        self._create_customer()
+        self.plan = StripeSubscriptionPlan.objects.create(
+            amount=100, name="plan", interval=StripeSubscriptionPlan.INTERVAL_MONTH, is_created_at_stripe=True)
+
+    def test_active_customer(self):
+        self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(self.user), self.customer)
+        with self.assertNumQueries(0):
+            self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(self.user), self.customer)
+
+        # the cache is invalidated when the transaction is committed, not to cache the old state again before
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.is_active = False
+            self.customer.save()
+            with self.assertNumQueries(0):
+                self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(self.user), self.customer)
+        self.assertIsNone(StripeCustomer.get_cached_active_customer_for_user(self.user))
+        with self.assertNumQueries(0):
+            self.assertIsNone(StripeCustomer.get_cached_active_customer_for_user(self.user))
+
+        # other users are not affected
+        other_user = self._create_user(email="bar@bar.bar", set_self=False)
+        self.assertIsNone(StripeCustomer.get_cached_active_customer_for_user(other_user))
+        with self.captureOnCommitCallbacks(execute=True):
+            new_customer = self._create_customer(user=other_user, customer_id="cus_new")
+        self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(other_user), new_customer)
+        with self.assertNumQueries(0):
+            self.assertIsNone(StripeCustomer.get_cached_active_customer_for_user(self.user))
+
+    @requests_mock.Mocker()
+    def test_active_subscription(self, m):
+        self.assertIsNone(StripeSubscription.get_cached_active_subscription_for_user(self.user))
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription = StripeSubscription.objects.create(
+                user=self.user, customer=self.customer, plan=self.plan, stripe_subscription_id="sub_xyz",
+                status=StripeSubscription.STATUS_ACTIVE, is_created_at_stripe=True)
+        self.assertEqual(StripeSubscription.get_cached_active_subscription_for_user(self.user), subscription)
+        with self.assertNumQueries(0):
+            StripeSubscription.get_cached_active_subscription_for_user(self.user)
+
+        # the plan is taken from the plan catalog
+        StripeSubscriptionPlan.objects.clear_catalog()
+        StripeSubscriptionPlan.objects.get_catalog()
+        with self.assertNumQueries(1):
+            self.assertEqual(StripeSubscription.get_active_subscription_for_user(self.user).plan.name, "plan")
+
+        # webhooks update subscriptions without saving them
+        payload = {
+            "id": "evt_1",
+            "object": "event",
+            "api_version": "2018-01-01",
+            "created": 1503477866,
+            "data": {"object": {"id": "sub_xyz", "object": "subscription", "status": "past_due"}},
+            "type": "customer.subscription.updated",
+        }
+        self.client.credentials(**self._get_signature_headers(payload))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("stripe-webhooks"), data=payload, format="json")
+        self.assertIsNone(StripeSubscription.get_cached_active_subscription_for_user(self.user))
+
+        # the same for syncs
+        self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(self.user).sources, [])
+        m.register_uri("GET", "https://api.stripe.com/v1/customers", text=json.dumps({
+            "object": "list", "url": "/v1/customers", "has_more": False, "data": [{
+                "id": "cus_xyz", "object": "customer", "default_source": "card_1",
+                "sources": {"object": "list", "data": [{"id": "card_1"}], "has_more": False}
+            }]
+        }))
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomerSync().run()
+        self.assertEqual(StripeCustomer.get_cached_active_customer_for_user(self.user).sources, [{"id": "card_1"}])
+
+    @requests_mock.Mocker()
+    def test_coupon(self, m):
+        # unknown coupons are cached as well
+        self.assertIsNone(StripeCoupon.get_cached_coupon("CODE"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(StripeCoupon.get_cached_coupon("CODE"))
+
+        # the cache is invalidated when the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = self._create_coupon("CODE", amount_off=1)
+            self.assertIsNone(StripeCoupon.get_cached_coupon("CODE"))
+        self.assertEqual(StripeCoupon.get_cached_coupon("CODE"), coupon)
+        with self.assertNumQueries(0):
+            self.assertEqual(StripeCoupon.get_cached_coupon("CODE").amount_off, 1)
+
+        # refresh_coupons
+        m.register_uri("GET", "https://api.stripe.com/v1/coupons", text=json.dumps({
+            "object": "list", "url": "/v1/coupons", "has_more": False,
+            "data": [dict(coupon.stripe_response, amount_off=200)],
+        }))
+        with self.captureOnCommitCallbacks(execute=True):
+            CouponSync().run()
+        self.assertEqual(StripeCoupon.get_cached_coupon("CODE").amount_off, 2)
+
+        # webhooks (the coupon is already deleted at Stripe)
+        m.register_uri("GET", "https://api.stripe.com/v1/coupons/CODE", status_code=404, text=json.dumps({
+            "error": {"type": "invalid_request_error", "message": "No such coupon: CODE"}
+        }))
+        payload = {
+            "id": "evt_1",
+            "object": "event",
+            "api_version": "2018-01-01",
+            "created": 1503477866,
+            "data": {"object": dict(coupon.stripe_response, amount_off=200)},
+            "type": "coupon.deleted",
+        }
+        self.client.credentials(**self._get_signature_headers(payload))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("stripe-webhooks"), data=payload, format="json")
+        self.assertIsNone(StripeCoupon.get_cached_coupon("CODE"))
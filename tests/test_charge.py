@@ -8,12 +8,17 @@ import stripe
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from freezegun import freeze_time
+from rest_framework.reverse import reverse
 from stripe.error import CardError, StripeError
 
 from aa_stripe.exceptions import StripeInternalError
 from aa_stripe.models import StripeCharge, StripeCustomer, StripeMethodNotAllowed
 from aa_stripe.signals import stripe_charge_card_exception, stripe_charge_refunded, stripe_charge_succeeded
+from tests.test_utils import BaseTestCase
 
 UserModel = get_user_model()
 
@@ -72,7 +77,7 @@ class TestCharges(TestCase):
             source=self.customer,
         )
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_charge_unknown_stripe_error(self, charge_create_mocked):
         stripe_error_json_body = {"error": {"type": "api_error"}}
         charge_create_mocked.side_effect = StripeError(json_body=stripe_error_json_body)
@@ -88,7 +93,7 @@ class TestCharges(TestCase):
         self.assertDictEqual(self.charge.stripe_response, stripe_error_json_body)
         self.assertIn("Exception happened", out.getvalue())
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_charge_stripe_error(self, charge_create_mocked):
         stripe_error_json_body = {
             "error": {
@@ -108,7 +113,7 @@ class TestCharges(TestCase):
         self.assertTrue(self.charge.charge_attempt_failed)
         self.assertDictEqual(self.charge.stripe_response, stripe_error_json_body)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_charge_card_declined(self, charge_create_mocked):
         card_error_json_body = {
             "error": {
@@ -128,7 +133,7 @@ class TestCharges(TestCase):
         self.assertDictEqual(self.charge.stripe_response, card_error_json_body)
         self.assertEqual(self.charge.stripe_charge_id, "ch_1F5C8nBszOVoiLmgPWC36cnI")
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_charge_with_idempotency_key(self, charge_create_mocked):
         charge_create_mocked.return_value = stripe.Charge(id="AA1")
         idempotency_key = "idempotency_key123"
@@ -149,9 +154,10 @@ class TestCharges(TestCase):
                 "origin": settings.PAYMENT_ORIGIN,
                 "member_uuid": str(self.user.uuid),
             },
+            api_key="sk_test_apikey",
         )
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_already_charged(self, charge_create_mocked):
         charge_create_mocked.return_value = stripe.Charge(id="AA1")
         self.charge.charge()
@@ -166,7 +172,7 @@ class TestCharges(TestCase):
         self.assertFalse(self.success_signal_was_called)
         self.assertFalse(self.exception_signal_was_called)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Charge.create")
+    @mock.patch("aa_stripe.models.stripe.Charge.create")
     def test_stripe_api_error(self, charge_create_mocked):
         error_json = {"error": {"message": "An unknown error occurred", "type": "api_error"}}
         charge_create_mocked.side_effect = stripe.error.APIError(
@@ -180,7 +186,7 @@ class TestCharges(TestCase):
             assert self.charge.charge_attempt_failed
             assert self.charge.stripe_response == error_json
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_refund_on_not_charged(self, refund_create_mocked):
         self.charge.refresh_from_db()
         refund_create_mocked.return_value = stripe.Refund(id="R1")
@@ -191,7 +197,7 @@ class TestCharges(TestCase):
         self.assertFalse(self.charge.is_refunded)
         self.assertFalse(self.charge_refunded_signal_was_called)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_already_refunded(self, refund_create_mocked):
         refund_create_mocked.return_value = stripe.Refund(id="R1")
         self.charge.is_charged = True
@@ -202,7 +208,7 @@ class TestCharges(TestCase):
         self.assertTrue(self.charge.is_refunded)
         self.assertFalse(self.charge_refunded_signal_was_called)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_full_refund(self, refund_create_mocked):
         refund_create_mocked.return_value = stripe.Refund(id="R1")
         self.charge.is_charged = True
@@ -212,7 +218,7 @@ class TestCharges(TestCase):
         self.assertEqual(self.charge.amount_refunded, self.charge.amount)
         self.assertTrue(self.charge_refunded_signal_was_called)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_partial_refund(self, refund_create_mocked):
         refund_create_mocked.return_value = stripe.Refund(id="R1")
         self.charge.is_charged = True
@@ -224,6 +230,7 @@ class TestCharges(TestCase):
                 charge=self.charge.stripe_charge_id,
                 amount=to_refund,
                 idempotency_key="{}-{}-{}-{}".format(self.charge.object_id, self.charge.content_type_id, 0, to_refund),
+                api_key="sk_test_apikey",
             )
             self.assertFalse(self.charge.is_refunded)
             refund_signal_send.assert_called_with(sender=StripeCharge, instance=self.charge)
@@ -237,12 +244,13 @@ class TestCharges(TestCase):
                 idempotency_key="{}-{}-{}-{}".format(
                     self.charge.object_id, self.charge.content_type_id, 30, to_refund
                 ),
+                api_key="sk_test_apikey",
             )
             self.assertFalse(self.charge.is_refunded)
             refund_signal_send.assert_called_with(sender=StripeCharge, instance=self.charge)
             self.assertEqual(self.charge.amount_refunded, 60)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_full_refund_of_partials(self, refund_create_mocked):
         refund_create_mocked.return_value = stripe.Refund(id="R1")
         self.charge.is_charged = True
@@ -254,6 +262,7 @@ class TestCharges(TestCase):
                 charge=self.charge.stripe_charge_id,
                 amount=to_refund,
                 idempotency_key="{}-{}-{}-{}".format(self.charge.object_id, self.charge.content_type_id, 0, to_refund),
+                api_key="sk_test_apikey",
             )
             self.assertFalse(self.charge.is_refunded)
             refund_signal_send.assert_called_with(sender=StripeCharge, instance=self.charge)
@@ -266,12 +275,13 @@ class TestCharges(TestCase):
                 idempotency_key="{}-{}-{}-{}".format(
                     self.charge.object_id, self.charge.content_type_id, 50, to_refund
                 ),
+                api_key="sk_test_apikey",
             )
             self.assertTrue(self.charge.is_refunded)
             refund_signal_send.assert_called_with(sender=StripeCharge, instance=self.charge)
             self.assertEqual(self.charge.amount_refunded, 100)
 
-    @mock.patch("aa_stripe.management.commands.charge_stripe.stripe.Refund.create")
+    @mock.patch("aa_stripe.models.stripe.Refund.create")
     def test_refund_over_charge_amount(self, refund_create_mocked):
         refund_create_mocked.return_value = stripe.Refund(id="R1")
         self.charge.is_charged = True
@@ -282,14 +292,14 @@ class TestCharges(TestCase):
         self.assertFalse(self.charge_refunded_signal_was_called)
 
     @mock.patch(
-        "aa_stripe.management.commands.charge_stripe.stripe.Refund.create",
+        "aa_stripe.models.stripe.Refund.create",
         side_effect=[
             stripe.error.InvalidRequestError("message", "param"),
             stripe.Refund(id="R1"),
         ],
     )
     @mock.patch(
-        "aa_stripe.management.commands.charge_stripe.stripe.Charge.retrieve",
+        "aa_stripe.models.stripe.Charge.retrieve",
         return_value=build_small_manual_refunded_charge(),
     )
     def test_refund_after_partial_manual_refund(self, refund_create_mocked, charge_retrieve_mocked):
@@ -300,11 +310,11 @@ class TestCharges(TestCase):
         self.assertEqual(self.charge.amount_refunded, 100)
 
     @mock.patch(
-        "aa_stripe.management.commands.charge_stripe.stripe.Refund.create",
+        "aa_stripe.models.stripe.Refund.create",
         side_effect=stripe.error.InvalidRequestError("message", "param", code="charge_already_refunded"),
     )
     @mock.patch(
-        "aa_stripe.management.commands.charge_stripe.stripe.Charge.retrieve",
+        "aa_stripe.models.stripe.Charge.retrieve",
         return_value=build_full_manual_refunded_charge(),
     )
     def test_already_manually_refunded(self, refund_create_mocked, charge_retrieve_mocked):
@@ -313,3 +323,67 @@ class TestCharges(TestCase):
         self.charge.refund(100)
 
         self.assertEqual(self.charge.amount_refunded, 100)
+
+    @freeze_time("2017-06-29 12:00:00+00")
+    @mock.patch("aa_stripe.sync.stripe.Charge.list")
+    def test_reconcile_charges(self, charge_list_mocked):
+        self.charge.is_charged = True
+        self.charge.stripe_charge_id = "ch_1"
+        self.charge.save()
+        charge_list_mocked.return_value = {
+            "has_more": False,
+            "data": [
+                {"id": "ch_1", "paid": True, "amount_refunded": 60, "refunded": False, "disputed": True},
+                # disputes of charges which do not exist locally are not counted
+                {"id": "ch_unknown", "paid": True, "amount_refunded": 0, "refunded": False, "disputed": True},
+            ],
+        }
+        out = StringIO()
+        sys.stdout = out
+        call_command("reconcile_charges", dry_run=True)
+        call_command("reconcile_charges", since="2017-06-01", until="2017-06-15")
+        sys.stdout = sys.__stdout__
+
+        # midnight in the current (America/Chicago) timezone
+        charge_list_mocked.assert_called_with(
+            limit=100, starting_after=None, created={"gte": 1496293200, "lt": 1497502800}, api_key="sk_test_apikey")
+        self.assertIn("amount_refunded: 1 (total 60 cents), disputed charges: 1", out.getvalue())
+        self.charge.refresh_from_db()
+        self.assertEqual(self.charge.amount_refunded, 60)
+        self.assertFalse(self.charge.is_refunded)
+
+
+class TestChargesAPI(BaseTestCase):
+    def setUp(self):
+        self._create_user()
+        self.charges = [
+            StripeCharge.objects.create(user=self.user, amount=100 * i, description="Charge {}".format(i))
+            for i in range(1, 6)
+        ]
+        other_user = self._create_user(email="other@user.com", set_self=False)
+        StripeCharge.objects.create(user=other_user, amount=100, description="Other")
+
+    def test_api(self):
+        url = reverse("stripe-charges")
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_authenticate(user=self.user)
+        charges = []
+        response = self.client.get(url, {"page_size": 2})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            charges += response.data["results"]
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+
+        # newest first, only charges of the user
+        self.assertEqual([charge["id"] for charge in charges], [charge.id for charge in reversed(self.charges)])
+        self.assertEqual(set(charges[0]), {
+            "id", "stripe_charge_id", "amount", "amount_refunded", "is_charged", "is_refunded", "charge_attempt_failed",
+            "description", "created",
+        })
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertNotIn("stripe_response", queries[-1]["sql"])
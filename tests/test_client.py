@@ -0,0 +1,64 @@
+import requests_mock
+import simplejson as json
+import stripe
+from django.test import TestCase
+
+from aa_stripe.client import configure_stripe, create_session, get_request_options, get_timeout, stripe_account_context
+from aa_stripe.models import StripeCustomer
+from aa_stripe.utils import run_concurrently
+
+
+class TestClient(TestCase):
+    def test_configure_stripe(self):
+        api_key = stripe.api_key
+        stripe.max_network_retries = 1
+        with self.settings(STRIPE_API_KEY="sk_test_1", STRIPE_HTTP_POOL_SIZE=2, STRIPE_MAX_NETWORK_RETRIES=3,
+                           STRIPE_HTTP_CONNECT_TIMEOUT=1, STRIPE_HTTP_READ_TIMEOUT=5):
+            configure_stripe()
+            http_client = stripe.default_http_client
+            # the API key is passed to each call instead of being set globally
+            self.assertEqual(stripe.api_key, api_key)
+            self.assertEqual(get_request_options(), {"api_key": "sk_test_1"})
+            self.assertEqual(stripe.max_network_retries, 3)
+            self.assertEqual(get_timeout(), (1, 5))
+            self.assertEqual(create_session().get_adapter(stripe.api_base)._pool_maxsize, 2)
+
+            # the client is shared by all the calls
+            configure_stripe()
+            self.assertIs(stripe.default_http_client, http_client)
+
+        # and created again when the settings change
+        configure_stripe()
+        self.assertIsNot(stripe.default_http_client, http_client)
+        self.assertEqual(stripe.max_network_retries, 3)  # not changed if STRIPE_MAX_NETWORK_RETRIES is not set
+        stripe.max_network_retries = 0
+
+    def test_warm_up(self):
+        with requests_mock.Mocker() as m, self.settings(STRIPE_HTTP_WARM_UP=True):
+            m.register_uri("HEAD", stripe.api_base)
+            configure_stripe()
+            self.assertTrue(m.called)
+
+    def test_stripe_account_context(self):
+        self.assertEqual(get_request_options(), {"api_key": "sk_test_apikey"})
+        with stripe_account_context(api_key="sk_test_other"):
+            self.assertEqual(get_request_options(), {"api_key": "sk_test_other"})
+            with stripe_account_context(stripe_account="acct_xyz"):
+                self.assertEqual(get_request_options(), {"api_key": "sk_test_other", "stripe_account": "acct_xyz"})
+                # the context is passed to the threads
+                results = [
+                    result for item, result, exc_info in run_concurrently(lambda item: get_request_options(), [1])
+                ]
+                self.assertEqual(results, [{"api_key": "sk_test_other", "stripe_account": "acct_xyz"}])
+            self.assertEqual(get_request_options(), {"api_key": "sk_test_other"})
+        self.assertEqual(get_request_options(), {"api_key": "sk_test_apikey"})
+
+    @requests_mock.Mocker()
+    def test_stripe_account_headers(self, m):
+        m.register_uri("GET", "https://api.stripe.com/v1/customers/cus_xyz", text=json.dumps({
+            "id": "cus_xyz", "object": "customer"}))
+        customer = StripeCustomer(stripe_customer_id="cus_xyz")
+        with stripe_account_context(api_key="sk_test_other", stripe_account="acct_xyz"):
+            customer.retrieve_from_stripe()
+        self.assertEqual(m.last_request.headers["Authorization"], "Bearer sk_test_other")
+        self.assertEqual(m.last_request.headers["Stripe-Account"], "acct_xyz")
@@ -1,17 +1,24 @@
 import time
 from datetime import datetime, timedelta
 from decimal import Decimal
+from urllib.parse import parse_qs
 
+import mock
 import requests_mock
 import simplejson as json
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.management import call_command
 from django.utils import dateformat, timezone
 from freezegun import freeze_time
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.reverse import reverse
 
+from aa_stripe.api import CouponDetailsAPI
 from aa_stripe.forms import StripeCouponForm
 from aa_stripe.models import StripeCoupon
+from aa_stripe.signals import stripe_coupons_deleted
+from aa_stripe.sync import CouponSync
 from aa_stripe.utils import timestamp_to_timezone_aware_date
 from tests.test_utils import BaseTestCase
 
@@ -19,6 +26,9 @@ UserModel = get_user_model()
 
 
 class TestCoupons(BaseTestCase):
+    def setUp(self):
+        cache.clear()
+
     @freeze_time("2016-01-01 00:00:00")
     def test_create(self):
         # test creating simple coupon with no coupon_id specified (will be generated by Stripe)
@@ -97,7 +107,7 @@ class TestCoupons(BaseTestCase):
 
             # try accessing coupon that does not exist - should delete the coupon from our database
             m.register_uri(
-                "GET",
+                "POST",
                 "https://api.stripe.com/v1/coupons/25OFF",
                 status_code=404,
                 text=json.dumps({"error": {"type": "invalid_request_error"}}),
@@ -119,7 +129,10 @@ class TestCoupons(BaseTestCase):
             )
             coupon = self._create_coupon(coupon_id="25OFF", duration=StripeCoupon.DURATION_FOREVER, amount_off=1)
             coupon.duration = StripeCoupon.DURATION_ONCE
+            m.reset_mock()
             coupon.save()
+            self.assertEqual(m.call_count, 1)  # a single update call, without retrieving the coupon
+            self.assertEqual(m.last_request.method, "POST")
             coupon.refresh_from_db()
             self.assertNotEqual(coupon.duration, StripeCoupon.DURATION_ONCE)
             self.assertEqual(
@@ -127,6 +140,28 @@ class TestCoupons(BaseTestCase):
                 timestamp_to_timezone_aware_date(stripe_response["redeem_by"]),
             )
 
+            # keys removed from metadata are unset at Stripe
+            stripe_response["metadata"] = {"old": "value"}
+            m.register_uri("POST", "https://api.stripe.com/v1/coupons/25OFF", text=json.dumps(stripe_response))
+            coupon.save()
+            coupon.metadata = {"new": "value"}
+            coupon.save()
+            self.assertEqual(parse_qs(m.last_request.text, keep_blank_values=True),
+                             {"metadata[new]": ["value"], "metadata[old]": [""]})
+
+            # keys saved by syncs are unset as well, they are not stored in stripe_response
+            stripe_response["metadata"] = {"new": "value"}
+            m.register_uri("POST", "https://api.stripe.com/v1/coupons/25OFF", text=json.dumps(stripe_response))
+            StripeCoupon.objects.filter(pk=coupon.pk).update(metadata={"new": "value", "synced": "value"})
+            coupon = StripeCoupon.objects.get(pk=coupon.pk)
+            coupon.metadata = {"new": "value"}
+            m.reset_mock()
+            with self.assertNumQueries(1):  # the coupon is saved once, without reading the saved metadata
+                coupon.save()
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(parse_qs(m.last_request.text, keep_blank_values=True),
+                             {"metadata[new]": ["value"], "metadata[synced]": [""]})
+
     def test_delete(self):
         coupon = self._create_coupon(coupon_id="CPON", amount_off=1, duration=StripeCoupon.DURATION_FOREVER)
         self.assertEqual(StripeCoupon.objects.deleted().count(), 0)
@@ -278,11 +313,104 @@ class TestCoupons(BaseTestCase):
         )
 
         # test accessing coupon that has already been deleted
-        # update does not call object's .save(), so we do not need to mock Stripe API
-        StripeCoupon.objects.filter(pk=coupon.pk).update(is_deleted=True)
+        # mark_deleted does not call object's .save(), so we do not need to mock Stripe API
+        with self.captureOnCommitCallbacks(execute=True):
+            StripeCoupon.objects.mark_deleted([coupon.pk])
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, 404)
 
+    def test_details_api_conditional_requests(self):
+        user = UserModel.objects.create(email="foo@bar.bar", username="foo", password="dump-password")
+        self.client.force_authenticate(user=user)
+        coupon = self._create_coupon("COUPON")
+        url = reverse("stripe-coupon-details", kwargs={"coupon_id": coupon.coupon_id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        # the coupon is not serialized if it has not changed, the database is not queried as the coupon is cached
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon.update_from_stripe_data(dict(coupon.stripe_response, metadata={"new": "data"}))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(json.loads(response.data["metadata"]), {"new": "data"})
+
+        # serialized coupons can be cached
+        with self.settings(STRIPE_API_CACHE_TIMEOUT=60):
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data["metadata"]), {"new": "data"})
+
+    def test_details_api_object_permissions(self):
+        class DenyObjectPermission(IsAuthenticated):
+            def has_object_permission(self, request, view, obj):
+                return False
+
+        user = UserModel.objects.create(email="foo@bar.bar", username="foo", password="dump-password")
+        self.client.force_authenticate(user=user)
+        coupon = self._create_coupon("COUPON")
+        url = reverse("stripe-coupon-details", kwargs={"coupon_id": coupon.coupon_id})
+        etag = self.client.get(url)["ETag"]
+        with mock.patch.object(CouponDetailsAPI, "permission_classes", (DenyObjectPermission,)):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 403)
+
+    def test_validation_api(self):
+        url = reverse("stripe-coupons-validation")
+        self.assertEqual(self.client.post(url, {"coupon_ids": ["A"]}, format="json").status_code, 403)
+
+        user = UserModel.objects.create(email="foo@bar.bar", username="foo", password="dump-password")
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.post(url, {"coupon_ids": []}, format="json").status_code, 400)
+
+        valid = self._create_coupon("VALID", amount_off=1)
+        StripeCoupon.objects.filter(pk=valid.pk).update(valid=True)
+        used = self._create_coupon("USED")
+        StripeCoupon.objects.filter(pk=used.pk).update(valid=True, max_redemptions=1, times_redeemed=1)
+        expired = self._create_coupon("EXPIRED")
+        StripeCoupon.objects.filter(pk=expired.pk).update(valid=True, redeem_by=timezone.now() - timedelta(days=1))
+        deleted = self._create_coupon("DELETED")
+        StripeCoupon.objects.mark_deleted([deleted.pk])
+
+        with self.assertNumQueries(1):
+            response = self.client.post(url, {
+                "coupon_ids": ["VALID", "USED", "EXPIRED", "DELETED", "UNKNOWN", "VALID"]
+            }, format="json")
+        self.assertEqual(response.status_code, 200)
+        results = response.data["results"]
+        self.assertEqual([result["coupon_id"] for result in results], ["VALID", "USED", "EXPIRED", "DELETED", "UNKNOWN"])
+        self.assertEqual([result["valid"] for result in results], [True, False, False, False, False])
+        self.assertEqual(results[0]["amount_off"], "1.00")
+        self.assertEqual(results[1]["times_redeemed"], 1)
+        self.assertEqual(results[3], {"coupon_id": "DELETED", "valid": False})
+
+    def test_sync_errors(self):
+        coupons = [self._create_coupon("1A"), self._create_coupon("2A")]
+        with requests_mock.Mocker() as m:
+            # the second coupon cannot be matched, so it cannot be marked as deleted
+            m.register_uri("GET", "https://api.stripe.com/v1/coupons", text=json.dumps({
+                "object": "list", "has_more": False,
+                "data": [coupons[0].stripe_response, {"id": "2A", "object": "coupon"}],
+            }))
+            stats = CouponSync().run()
+            self.assertEqual(stats["errors"], 1)
+            self.assertEqual(stats["deleted"], 0)
+            self.assertEqual(StripeCoupon.objects.count(), 2)
+
+            m.register_uri("GET", "https://api.stripe.com/v1/coupons", text=json.dumps({
+                "object": "list", "has_more": False, "data": [coupons[0].stripe_response],
+            }))
+            stats = CouponSync().run()
+            self.assertEqual(stats["deleted"], 1)
+            self.assertEqual(list(StripeCoupon.objects.all()), [coupons[0]])
+
     def test_refresh_coupons_command(self):
         coupons = {
             "1A": self._create_coupon("1A"),
@@ -344,7 +472,19 @@ class TestCoupons(BaseTestCase):
                 text=json.dumps(new_coupon_stripe_response),
             )
 
+            received = []
+
+            def coupons_deleted_receiver(sender, pks, **kwargs):
+                # the coupons are already marked as deleted when the signal is sent
+                received.append((sender, list(pks), list(StripeCoupon.objects.deleted().filter(
+                    pk__in=pks).order_by("pk").values_list("pk", flat=True))))
+
+            stripe_coupons_deleted.connect(coupons_deleted_receiver, sender=StripeCoupon)
+            self.addCleanup(stripe_coupons_deleted.disconnect, coupons_deleted_receiver, sender=StripeCoupon)
             call_command("refresh_coupons")
+            # stale coupons are announced once per batch
+            stale_pks = [coupons["2A"].pk, coupons["4A"].pk]
+            self.assertEqual(received, [(StripeCoupon, stale_pks, stale_pks)])
             self.assertEqual(StripeCoupon.objects.all_with_deleted().count(), 7)  # 4 + 3 were created
             for coupon_id, coupon in coupons.items():
                 coupons[coupon_id] = StripeCoupon.objects.all_with_deleted().get(pk=coupon.pk)
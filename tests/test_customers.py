@@ -6,7 +6,9 @@ from django.contrib.auth import get_user_model
 from django.core.management import call_command
 from rest_framework.reverse import reverse
 
-from aa_stripe.models import StripeCustomer
+from aa_stripe.cache import memoize
+from aa_stripe.middleware import MemoizeMiddleware
+from aa_stripe.models import SourcesDescriptor, StripeCustomer
 from tests.test_utils import BaseTestCase
 
 UserModel = get_user_model()
@@ -142,12 +144,24 @@ class TestCreatingUsers(BaseTestCase):
 
     def test_change_description(self):
         customer_id = self.stripe_js_response["id"]
-        customer = StripeCustomer(user=self.user, stripe_customer_id=customer_id)
+        customer = StripeCustomer.objects.create(user=self.user, stripe_customer_id=customer_id)
         api_url = "https://api.stripe.com/v1/customers/{customer_id}".format(customer_id=customer_id)
+        stripe_customer = {
+            "id": customer_id, "object": "customer", "description": "abc", "default_source": "card_xyz",
+            "sources": {"object": "list", "data": [{"id": "card_xyz", "object": "card"}], "has_more": False},
+        }
         with requests_mock.Mocker() as m:
-            m.register_uri("GET", api_url, text=json.dumps(self.stripe_js_response))
-            m.register_uri("POST", api_url, text=json.dumps(self.stripe_js_response))
+            m.register_uri("GET", api_url, text=json.dumps(stripe_customer))
+            m.register_uri("POST", api_url, text=json.dumps(stripe_customer))
             customer.change_description("abc")
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(m.last_request.text, "description=abc")
+
+        # the local object is updated from the response
+        customer = StripeCustomer.objects.with_json().get(pk=customer.pk)
+        self.assertEqual(customer.stripe_response["description"], "abc")
+        self.assertEqual(customer.default_source, "card_xyz")
+        self.assertTrue(customer.stripe_digest)
 
 
 class TestCustomerDetailsAPI(BaseTestCase):
@@ -249,6 +263,43 @@ class TestCustomerDetailsAPI(BaseTestCase):
             response = self.client.patch(self.url, data, format="json")
             self.assertEqual(response.status_code, 200)
             self.assertEqual(dict(response.data["default_source_data"]), {"id": "card_2", "object": "card"})
+            self.assertEqual([request.method for request in m.request_history], ["POST", "POST"])
+
+        # the response carries the ETag of the updated customer
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    def test_conditional_requests(self):
+        self.client.force_authenticate(user=self.user)
+        etag = self.client.get(self.url)["ETag"]
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.customer.default_source = ""
+        self.customer.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data["default_source_data"])
+
+        self.client.force_authenticate(user=self.second_user)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+
+class TestCustomersAPI(BaseTestCase):
+    def test_list(self):
+        self._create_user()
+        self._create_customer(customer_id="cus_old", sources=[{"id": "card_1"}], default_source="card_1")
+        self._create_customer(customer_id="cus_new", sources=[{"id": "card_2"}], default_source="card_2")
+        self._create_customer(user=self._create_user(email="other@user.com", set_self=False), customer_id="cus_other")
+
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("stripe-customers"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([customer["stripe_customer_id"] for customer in response.data["results"]],
+                         ["cus_new", "cus_old"])
+        self.assertEqual(response.data["results"][0]["default_source_data"], {"id": "card_2"})
+        self.assertNotIn("sources", response.data["results"][0])
 
 
 class TestRefreshCustomersCommand(BaseTestCase):
@@ -341,6 +392,10 @@ class TestRefreshCustomersCommand(BaseTestCase):
         self.assertEqual(self.customer.sources, [{"id": "card_xyz", "object": "card"}])
         self.assertEqual(self.customer.default_source, "card_xyz")
 
+        # the customer is not saved again if Stripe data has not changed
+        with self.assertNumQueries(0):
+            self.customer.refresh_from_stripe()
+
     def test_get_default_source(self):
         self._create_customer()
         self.customer.sources = [{"id": "card_abc"}, {"id": "card_xyz"}]
@@ -350,3 +405,84 @@ class TestRefreshCustomersCommand(BaseTestCase):
         self.customer.default_source = "card_xyz"
         self.customer.save()
         self.assertEqual(self.customer.default_source_data, {"id": "card_xyz"})
+
+        # the index of sources is reset when sources are replaced
+        self.customer.sources = [{"id": "card_xyz", "brand": "Visa"}]
+        self.assertEqual(self.customer.default_source_data, {"id": "card_xyz", "brand": "Visa"})
+        self.customer.default_source = "card_abc"
+        self.assertIsNone(self.customer.default_source_data)
+
+    def test_sources_change_tracking(self):
+        self._create_customer(sources=[{"id": "card_abc"}])
+        customer = StripeCustomer.objects.get(pk=self.customer.pk)
+        self.assertNotIn("_old_sources", customer.__dict__)  # nothing is copied until sources are changed
+        self.assertEqual(customer._old_sources, [{"id": "card_abc"}])
+
+        customer.sources = [{"id": "card_xyz"}]
+        customer.sources = []
+        self.assertEqual(customer._old_sources, [{"id": "card_abc"}])
+        self.assertEqual(customer.sources, [])
+
+        customer = StripeCustomer.objects.only("id").get(pk=self.customer.pk)
+        self.assertEqual(customer.sources, [{"id": "card_abc"}])
+        self.assertEqual(customer._old_sources, [{"id": "card_abc"}])
+
+        # _old_sources can still be assigned, ie. to reset change tracking
+        customer._old_sources = []
+        customer.sources = [{"id": "card_xyz"}]
+        self.assertEqual(customer._old_sources, [])
+        self.assertIsInstance(StripeCustomer.__dict__["sources"], SourcesDescriptor)
+
+    def test_deferred_json_fields(self):
+        self._create_customer(sources=[{"id": "card_abc"}])
+        customer = StripeCustomer.objects.get(pk=self.customer.pk)
+        self.assertEqual(customer.get_deferred_fields(), {"stripe_response", "stripe_js_response"})
+        with self.assertNumQueries(0):
+            self.assertEqual(customer.sources, [{"id": "card_abc"}])
+        with self.assertNumQueries(1):
+            self.assertEqual(customer.stripe_js_response, self.customer.stripe_js_response)
+
+        customer = StripeCustomer.objects.with_json().get(pk=self.customer.pk)
+        self.assertEqual(customer.get_deferred_fields(), set())
+
+
+class TestLatestActiveCustomer(BaseTestCase):
+    def setUp(self):
+        self._create_user()
+
+    def test_get_latest_active_customer_memoized(self):
+        self._create_customer(customer_id="cus_old")
+        customer = self._create_customer()
+        other_user = self._create_user(email="bar@bar.bar", set_self=False)
+
+        # every call makes a query outside of memoize() blocks
+        with self.assertNumQueries(2):
+            self.assertEqual(StripeCustomer.get_latest_active_customer_for_user(self.user), customer)
+            self.assertEqual(StripeCustomer.get_latest_active_customer_for_user(self.user), customer)
+
+        with memoize():
+            with self.assertNumQueries(2):
+                for i in range(3):
+                    self.assertEqual(StripeCustomer.get_latest_active_customer_for_user(self.user), customer)
+                    self.assertIsNone(StripeCustomer.get_latest_active_customer_for_user(other_user))
+
+            # saving a customer invalidates the memoized value
+            customer.is_active = False
+            customer.save()
+            with self.assertNumQueries(1):
+                self.assertEqual(StripeCustomer.get_latest_active_customer_for_user(self.user).stripe_customer_id,
+                                 "cus_old")
+                StripeCustomer.get_latest_active_customer_for_user(self.user)
+                StripeCustomer.get_latest_active_customer_for_user(other_user)
+
+    def test_memoize_middleware(self):
+        customer = self._create_customer()
+
+        def get_response(request):
+            with self.assertNumQueries(1):
+                for i in range(3):
+                    self.assertEqual(StripeCustomer.get_latest_active_customer_for_user(self.user), customer)
+
+        MemoizeMiddleware(get_response)(None)
+        with self.assertNumQueries(1):
+            StripeCustomer.get_latest_active_customer_for_user(self.user)
@@ -6,3 +6,15 @@ from aa_stripe.settings import stripe_settings
 class TestSettings(TestCase):
     def test_defaults(self):
         self.assertEqual(stripe_settings.PENDING_WEBHOOKS_THRESHOLD, 20)
+        self.assertEqual(stripe_settings.WORKERS, 4)
+        self.assertEqual(stripe_settings.API_RATE_LIMIT, 20)
+        self.assertEqual(stripe_settings.CACHE_ALIAS, "default")
+        self.assertEqual(stripe_settings.CACHE_TIMEOUT, 3600)
+        self.assertEqual(stripe_settings.PLAN_CATALOG_TIMEOUT, 300)
+        self.assertEqual(stripe_settings.RESPONSE_EXCLUDE_FIELDS, {})
+        self.assertEqual(stripe_settings.HTTP_POOL_SIZE, 10)
+        self.assertEqual(stripe_settings.HTTP_CONNECT_TIMEOUT, 10)
+        self.assertEqual(stripe_settings.HTTP_READ_TIMEOUT, 80)
+        self.assertIsNone(stripe_settings.MAX_NETWORK_RETRIES)
+        self.assertFalse(stripe_settings.HTTP_WARM_UP)
+        self.assertEqual(stripe_settings.API_CACHE_TIMEOUT, 0)
@@ -2,6 +2,7 @@
 import requests_mock
 import simplejson as json
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
 
 from aa_stripe.models import StripeSubscriptionPlan
@@ -42,3 +43,73 @@ class TestSubscriptionsPlans(TestCase):
             self.assertTrue(plan.is_created_at_stripe)
             self.assertEqual(plan.stripe_response["id"], plan.id)
             self.assertEqual(plan.stripe_response["amount"], 5000)
+
+    def test_plan_catalog(self):
+        StripeSubscriptionPlan.objects.clear_catalog()
+        plan = StripeSubscriptionPlan.objects.create(
+            amount=5000, name="gold-basic", interval=StripeSubscriptionPlan.INTERVAL_MONTH)
+        with self.assertNumQueries(1):
+            self.assertEqual(StripeSubscriptionPlan.objects.get_catalog(), {plan.id: plan})
+            self.assertEqual(StripeSubscriptionPlan.objects.get_cached(plan.id).name, "gold-basic")
+
+        # the catalog is cleared when a plan is saved, after the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            plan.name = "gold"
+            plan.save()
+            self.assertEqual(StripeSubscriptionPlan.objects.get_cached(plan.id).name, "gold-basic")
+        self.assertEqual(StripeSubscriptionPlan.objects.get_cached(plan.id).name, "gold")
+        with self.assertNumQueries(0):
+            StripeSubscriptionPlan.objects.get_cached(plan.id)
+
+        with self.assertRaises(StripeSubscriptionPlan.DoesNotExist):
+            StripeSubscriptionPlan.objects.get_cached(plan.id + 1)
+
+        with self.settings(STRIPE_PLAN_CATALOG_TIMEOUT=-1), self.assertNumQueries(1):
+            StripeSubscriptionPlan.objects.get_cached(plan.id)
+
+    def test_provision_plans(self):
+        plans = [
+            StripeSubscriptionPlan.objects.create(
+                amount=amount, name="plan-{}".format(amount), interval=StripeSubscriptionPlan.INTERVAL_MONTH)
+            for amount in [100, 200, 300]
+        ]
+        dashboard_plan_id = plans[-1].id + 10
+
+        def plan_data(plan_id, amount):
+            return {
+                "id": str(plan_id), "object": "plan", "amount": amount, "currency": "usd", "interval": "month",
+                "interval_count": 1, "name": "plan-{}".format(amount), "metadata": {}, "statement_descriptor": None,
+                "trial_period_days": None,
+            }
+
+        with requests_mock.Mocker() as m:
+            m.register_uri("POST", "https://api.stripe.com/v1/plans", [
+                {"text": json.dumps(plan_data(plans[0].id, 100))},
+                {"status_code": 400, "text": json.dumps({"error": {
+                    "type": "invalid_request_error", "code": "resource_already_exists", "message": "Plan already exists."
+                }})},
+                {"status_code": 500, "text": json.dumps({"error": {"type": "api_error", "message": "Error"}})},
+            ])
+            m.register_uri("GET", "https://api.stripe.com/v1/plans/{}".format(plans[1].id),
+                           text=json.dumps(plan_data(plans[1].id, 200)))
+            failures = StripeSubscriptionPlan.create_all_at_stripe(workers=1, rate_limit=100)
+            self.assertEqual(len(failures), 1)
+            self.assertEqual(failures[0]["obj"], plans[2])
+            self.assertEqual(
+                list(StripeSubscriptionPlan.objects.filter(is_created_at_stripe=True).order_by("id")), plans[:2])
+
+            # the rest of plans is created with --provision, plans created in the dashboard are created locally
+            m.register_uri("POST", "https://api.stripe.com/v1/plans", text=json.dumps(plan_data(plans[2].id, 300)))
+            m.register_uri("GET", "https://api.stripe.com/v1/plans", text=json.dumps({
+                "object": "list", "url": "/v1/plans", "has_more": False, "data": [
+                    plan_data(plan.id, plan.amount) for plan in plans
+                ] + [plan_data(dashboard_plan_id, 1000), plan_data("gold", 2000)]
+            }))
+            call_command("refresh_plans", provision=True)
+
+        plans[2].refresh_from_db()
+        self.assertTrue(plans[2].is_created_at_stripe)
+        dashboard_plan = StripeSubscriptionPlan.objects.get(pk=dashboard_plan_id)
+        self.assertTrue(dashboard_plan.is_created_at_stripe)
+        self.assertEqual(dashboard_plan.amount, 1000)
+        self.assertEqual(StripeSubscriptionPlan.objects.count(), 4)
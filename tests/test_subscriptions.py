@@ -1,16 +1,20 @@
 """Test charging users through the StripeCharge model"""
-from datetime import timedelta
+from datetime import date, datetime, timedelta
 
 import mock
 import requests_mock
 import simplejson as json
+import stripe
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
 from django.test import TestCase
 from django.utils import timezone
 from freezegun import freeze_time
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
 
 from aa_stripe.models import StripeCustomer, StripeSubscription, StripeSubscriptionPlan
+from aa_stripe.utils import timestamp_to_timezone_aware_date
 
 UserModel = get_user_model()
 
@@ -120,6 +124,17 @@ class TestSubscriptions(TestCase):
             subscription.refresh_from_stripe()
             self.assertEqual(subscription.status, subscription.STATUS_PAST_DUE)
             self.assertEqual(subscription.stripe_response["current_period_start"], 1496869999)
+            self.assertIs(type(subscription.stripe_response["plan"]), dict)
+
+            # fields which are never read can be dropped from stripe_response
+            stripe_subscription_raw["status"] = "active"
+            m.register_uri("GET", "https://api.stripe.com/v1/subscriptions/sub_AnksTMRdnWfq9m",
+                           [{"text": json.dumps(stripe_subscription_raw)}])
+            with self.settings(STRIPE_RESPONSE_EXCLUDE_FIELDS={"subscription": ["plan"]}):
+                subscription.refresh_from_stripe()
+            subscription.refresh_from_db()
+            self.assertNotIn("plan", subscription.stripe_response)
+            self.assertEqual(subscription.stripe_response["id"], "sub_AnksTMRdnWfq9m")
 
     @freeze_time("2017-06-29 12:00:00+00")
     def test_subscriptions_end(self):
@@ -152,3 +167,258 @@ class TestSubscriptions(TestCase):
                 mocked_cancel.reset_mock()
                 call_command("end_subscriptions")
                 mocked_cancel.assert_not_called()
+
+    def test_cancel(self):
+        subscription = StripeSubscription.objects.create(
+            customer=self.customer,
+            user=self.user,
+            plan=self.plan,
+            stripe_subscription_id="sub_AnksTMRdnWfq9m",
+            is_created_at_stripe=True,
+            status=StripeSubscription.STATUS_ACTIVE,
+        )
+        with requests_mock.Mocker() as m:
+            # the subscription is not retrieved from Stripe before canceling
+            m.register_uri("DELETE", "https://api.stripe.com/v1/subscriptions/sub_AnksTMRdnWfq9m", text=json.dumps({
+                "id": "sub_AnksTMRdnWfq9m", "object": "subscription", "status": "active", "cancel_at_period_end": True,
+                "canceled_at": 1496861935
+            }))
+            with self.assertNumQueries(1):
+                subscription.cancel(at_period_end=True)
+            self.assertEqual(m.call_count, 1)
+            self.assertIn("at_period_end=True", m.last_request.url)
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+            self.assertTrue(subscription.at_period_end)
+            self.assertEqual(subscription.canceled_at, timestamp_to_timezone_aware_date(1496861935))
+            self.assertEqual(subscription.stripe_response["id"], "sub_AnksTMRdnWfq9m")
+
+            # already canceled subscriptions are not sent to Stripe again
+            subscription.cancel()
+            self.assertEqual(m.call_count, 1)
+
+            # subscription canceled at Stripe, but not locally
+            subscription.status = StripeSubscription.STATUS_ACTIVE
+            subscription.save()
+            m.register_uri(
+                "DELETE", "https://api.stripe.com/v1/subscriptions/sub_AnksTMRdnWfq9m", status_code=404,
+                text=json.dumps({"error": {
+                    "type": "invalid_request_error", "code": "resource_missing",
+                    "message": "No such subscription: sub_AnksTMRdnWfq9m"
+                }}))
+            with self.assertNumQueries(1):
+                subscription.cancel()
+            self.assertEqual(m.call_count, 2)
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+            self.assertFalse(subscription.at_period_end)
+
+    def test_refresh_subscriptions_command(self):
+        subscriptions = [
+            StripeSubscription.objects.create(
+                customer=self.customer, user=self.user, plan=self.plan, stripe_subscription_id=subscription_id,
+                is_created_at_stripe=True, status=StripeSubscription.STATUS_ACTIVE)
+            for subscription_id in ["sub_1", "sub_2"]
+        ]
+        stripe_response = {
+            "object": "list",
+            "url": "/v1/subscriptions",
+            "has_more": False,
+            "data": [
+                {"id": "sub_1", "object": "subscription", "status": "canceled", "cancel_at_period_end": False,
+                 "canceled_at": 1496861935},
+                {"id": "sub_2", "object": "subscription", "status": "active", "cancel_at_period_end": True,
+                 "canceled_at": 1496861935},
+            ]
+        }
+        with requests_mock.Mocker() as m:
+            # the subscription refreshed with the same data is not updated by the command again, so its state has to be
+            # the same as the one set by the command
+            m.register_uri(
+                "GET", "https://api.stripe.com/v1/subscriptions/sub_2", text=json.dumps(stripe_response["data"][1]))
+            subscriptions[1].refresh_from_stripe()
+            m.register_uri("GET", "https://api.stripe.com/v1/subscriptions?status=all", text=json.dumps(stripe_response))
+            call_command("refresh_subscriptions")
+            self.assertEqual(m.call_count, 2)
+
+            for subscription in subscriptions:
+                subscription.refresh_from_db()
+                self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+                self.assertEqual(subscription.canceled_at, timestamp_to_timezone_aware_date(1496861935))
+                self.assertEqual(subscription.stripe_response["id"], subscription.stripe_subscription_id)
+                # stamped with the time of the request, older webhook events do not overwrite the data
+                self.assertIsNotNone(subscription.stripe_event_created)
+            self.assertFalse(subscriptions[0].at_period_end)
+            self.assertTrue(subscriptions[1].at_period_end)
+
+            stripe_response["data"] = []
+            m.register_uri(
+                "GET", "https://api.stripe.com/v1/subscriptions?status=past_due", text=json.dumps(stripe_response))
+            call_command("refresh_subscriptions", status="past_due")
+            self.assertEqual(m.call_count, 3)
+            self.assertIn("status=past_due", m.last_request.url)
+
+    @freeze_time("2017-06-29 12:00:00+00")
+    def test_subscriptions_end_failures(self):
+        subscriptions = [
+            StripeSubscription.objects.create(
+                customer=self.customer, user=self.user, plan=self.plan, stripe_subscription_id=subscription_id,
+                is_created_at_stripe=True, status=StripeSubscription.STATUS_ACTIVE, end_date=timezone.now())
+            for subscription_id in ["sub_1", "sub_2", "sub_3"]
+        ]
+        with requests_mock.Mocker() as m:
+            for subscription in subscriptions:
+                m.register_uri(
+                    "DELETE", "https://api.stripe.com/v1/subscriptions/{}".format(subscription.stripe_subscription_id),
+                    text=json.dumps({"id": subscription.stripe_subscription_id, "status": "canceled"}))
+            m.register_uri("DELETE", "https://api.stripe.com/v1/subscriptions/sub_2", status_code=400, text=json.dumps(
+                {"error": {"type": "invalid_request_error", "message": "Invalid request"}}))
+
+            # one broken subscription does not stop canceling the others
+            failures = StripeSubscription.end_subscriptions(workers=3, rate_limit=100)
+            self.assertEqual(m.call_count, 3)
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0]["obj"], subscriptions[1])
+        self.assertEqual(failures[0]["exc_type"], stripe.error.InvalidRequestError)
+        self.assertEqual(
+            list(StripeSubscription.objects.filter(status=StripeSubscription.STATUS_CANCELED).order_by("id")),
+            [subscriptions[0], subscriptions[2]])
+
+    @freeze_time("2017-06-29 12:00:00+00")
+    def test_subscriptions_end_scheduling(self):
+        subscription = StripeSubscription.objects.create(
+            customer=self.customer, user=self.user, plan=self.plan, status=StripeSubscription.STATUS_ACTIVE,
+            end_date="2017-07-04")
+        # an hour before the end date begins in the current timezone (America/Chicago)
+        self.assertEqual(subscription.end_at, timezone.make_aware(datetime(2017, 7, 3, 23)))
+        subscription.end_date = None
+        subscription.save(update_fields=["end_date"])
+        subscription.refresh_from_db()
+        self.assertIsNone(subscription.end_at)
+        # bulk updates of the end date are taken into account as well
+        StripeSubscription.objects.filter(pk=subscription.pk).update(end_date="2017-06-30")
+        subscription.refresh_from_db()
+
+        self.assertFalse(StripeSubscription.get_subcriptions_for_cancel().exists())
+        self.assertEqual(StripeSubscription.get_next_end_at(), subscription.end_at)
+        with mock.patch("aa_stripe.management.commands.end_subscriptions.sleep") as mocked_sleep, \
+                mock.patch("aa_stripe.models.StripeSubscription._stripe_cancel") as mocked_cancel, \
+                mock.patch("aa_stripe.management.commands.end_subscriptions.close_old_connections") as mocked_close:
+            mocked_cancel.return_value = {"status": "canceled"}
+            mocked_sleep.side_effect = KeyboardInterrupt
+            call_command("end_subscriptions", interval=3600 * 24)
+            # sleeps until the subscription is due
+            mocked_sleep.assert_called_once_with(3600 * 16)
+            mocked_cancel.assert_not_called()
+            mocked_close.assert_called_once_with()
+
+            mocked_sleep.reset_mock()
+            with freeze_time("2017-06-30 04:00:00+00"):
+                call_command("end_subscriptions", interval=60)
+                mocked_cancel.assert_called_once_with(at_period_end=True)
+                mocked_sleep.assert_called_once_with(60)
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+
+    def test_migrate_plan(self):
+        new_plan = StripeSubscriptionPlan.objects.create(
+            amount=200, is_created_at_stripe=True, name="new plan", interval=StripeSubscriptionPlan.INTERVAL_MONTH)
+        subscriptions = [
+            StripeSubscription.objects.create(
+                customer=self.customer, user=self.user, plan=self.plan, stripe_subscription_id=subscription_id,
+                is_created_at_stripe=True, status=status)
+            for subscription_id, status in [
+                ("sub_1", StripeSubscription.STATUS_ACTIVE), ("sub_2", StripeSubscription.STATUS_PAST_DUE),
+                ("sub_3", StripeSubscription.STATUS_ACTIVE), ("sub_4", StripeSubscription.STATUS_CANCELED),
+            ]
+        ]
+        with requests_mock.Mocker() as m:
+            for subscription in subscriptions:
+                m.register_uri(
+                    "POST", "https://api.stripe.com/v1/subscriptions/{}".format(subscription.stripe_subscription_id),
+                    text=json.dumps({"id": subscription.stripe_subscription_id, "object": "subscription",
+                                     "status": subscription.status, "plan": {"id": str(new_plan.id)}}))
+            m.register_uri("POST", "https://api.stripe.com/v1/subscriptions/sub_3", status_code=500, text=json.dumps(
+                {"error": {"type": "api_error", "message": "Error"}}))
+
+            call_command("migrate_subscription_plan", self.plan.id, new_plan.id, dry_run=True)
+            self.assertFalse(m.called)
+
+            failures = StripeSubscription.migrate_plan(self.plan, new_plan, batch_size=1, rate_limit=100, token="m1")
+            self.assertEqual(len(failures), 1)
+            self.assertEqual(failures[0]["obj"], subscriptions[2])
+            self.assertEqual(m.call_count, 3)  # canceled subscriptions are not moved
+            self.assertEqual(m.request_history[0].headers["Idempotency-Key"], "aa-stripe-migrate-plan-m1-sub_1")
+            self.assertIn("plan={}".format(new_plan.id), m.request_history[0].body)
+
+            for subscription, plan in zip(subscriptions, [new_plan, new_plan, self.plan, self.plan]):
+                subscription.refresh_from_db()
+                self.assertEqual(subscription.plan, plan)
+            self.assertEqual(subscriptions[0].stripe_response["plan"]["id"], str(new_plan.id))
+
+            # resume, only the failed subscription is sent again
+            m.register_uri("POST", "https://api.stripe.com/v1/subscriptions/sub_3", text=json.dumps(
+                {"id": "sub_3", "object": "subscription", "status": "active"}))
+            call_command("migrate_subscription_plan", self.plan.id, new_plan.id, status=["active"], token="m1")
+            self.assertEqual(m.call_count, 4)
+            self.assertEqual(m.last_request.path, "/v1/subscriptions/sub_3")
+            self.assertEqual(m.last_request.headers["Idempotency-Key"], "aa-stripe-migrate-plan-m1-sub_3")
+            subscriptions[2].refresh_from_db()
+            self.assertEqual(subscriptions[2].plan, new_plan)
+
+            # migrating the subscriptions back uses new idempotency keys
+            call_command("migrate_subscription_plan", new_plan.id, self.plan.id)
+            self.assertEqual(m.call_count, 7)
+            self.assertNotEqual(m.last_request.headers["Idempotency-Key"], "aa-stripe-migrate-plan-m1-sub_3")
+
+    @freeze_time("2017-06-29 12:00:00+00")
+    def test_forecast(self):
+        def create_subscription(current_period_end, status=StripeSubscription.STATUS_ACTIVE, end_date=None,
+                                plan=self.plan):
+            subscription = StripeSubscription.objects.create(
+                customer=self.customer, user=self.user, plan=plan, status=status, end_date=end_date)
+            subscription.set_stripe_data({"id": "sub_{}".format(subscription.id), "object": "subscription",
+                                          "status": status, "current_period_end": current_period_end})
+            return subscription
+
+        subscription = create_subscription(1498845600)
+        self.assertEqual(subscription.current_period_end, timestamp_to_timezone_aware_date(1498845600))
+        create_subscription(1498845600, status=StripeSubscription.STATUS_TRIAL)
+        create_subscription(1498845600, status=StripeSubscription.STATUS_CANCELED)
+        create_subscription(1499040000, end_date="2017-07-01")  # canceled before renewal
+        create_subscription(1509040000)  # out of range
+        # subscriptions of daily plans are renewed every day
+        daily_plan = StripeSubscriptionPlan.objects.create(
+            amount=100, name="daily", interval=StripeSubscriptionPlan.INTERVAL_DAY, is_created_at_stripe=True)
+        create_subscription(1498845600, plan=daily_plan)
+        create_subscription(1498845600, plan=daily_plan, end_date="2017-07-01")
+
+        with self.assertNumQueries(2):
+            forecast = StripeSubscription.forecast(days=3)
+        self.assertEqual(forecast, [
+            {"date": date(2017, 6, 29), "renewals": 0, "cancels": 0},
+            {"date": date(2017, 6, 30), "renewals": 4, "cancels": 2},
+            {"date": date(2017, 7, 1), "renewals": 1, "cancels": 0},
+        ])
+        call_command("forecast_subscriptions", days=3)
+
+    def test_subscriptions_api(self):
+        subscription = StripeSubscription.objects.create(
+            customer=self.customer, user=self.user, plan=self.plan, stripe_subscription_id="sub_1",
+            status=StripeSubscription.STATUS_ACTIVE)
+        other_user = UserModel.objects.create(email="bar@bar.bar", username="bar", password="dump-password")
+        StripeSubscription.objects.create(user=other_user, plan=self.plan)
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = client.get(reverse("stripe-subscriptions"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data["next"])
+        self.assertEqual(len(response.data["results"]), 1)
+        data = response.data["results"][0]
+        self.assertEqual(data["id"], subscription.id)
+        self.assertEqual(data["plan"], self.plan.id)
+        self.assertEqual(data["status"], StripeSubscription.STATUS_ACTIVE)
@@ -0,0 +1,126 @@
+import requests_mock
+import simplejson as json
+from django.core.management import call_command
+
+from aa_stripe.models import StripeCharge, StripeSubscription, StripeSubscriptionPlan
+from aa_stripe.sync import ChargeSync, CustomerSync
+from tests.test_utils import BaseTestCase
+
+
+class TestStripeSync(BaseTestCase):
+    def setUp(self):
+        self._create_user()
+        self._create_customer(customer_id="cus_a", sources=[{"id": "card_1"}], default_source="card_1")
+        self.second_customer = self._create_customer(customer_id="cus_b")
+
+    def _get_list_response(self, data, has_more=False):
+        return json.dumps({"object": "list", "url": "/v1/customers", "has_more": has_more, "data": data})
+
+    def _get_customer_data(self, customer_id, sources, default_source=None):
+        return {
+            "id": customer_id,
+            "object": "customer",
+            "sources": {"object": "list", "data": sources, "has_more": False},
+            "default_source": default_source,
+        }
+
+    @requests_mock.Mocker()
+    def test_change_detection(self, m):
+        m.register_uri("GET", "https://api.stripe.com/v1/customers", text=self._get_list_response([
+            self._get_customer_data("cus_a", [{"id": "card_1"}], default_source="card_1"),
+            self._get_customer_data("cus_b", [{"id": "card_2"}], default_source="card_2"),
+            self._get_customer_data("cus_unknown", []),
+            {"id": "cus_broken", "object": "customer"},
+        ]))
+        stats = CustomerSync(dry_run=True).run()
+        self.assertEqual(stats["pages"], 1)
+        self.assertEqual(stats["fetched"], 4)
+        self.assertEqual(stats["updated"], 2)  # digest of Stripe data has not been stored yet
+        self.assertEqual(stats["unchanged"], 0)
+        self.assertEqual(stats["missing"], 1)
+        self.assertEqual(stats["errors"], 1)
+        self.second_customer.refresh_from_db()
+        self.assertEqual(self.second_customer.sources, [])  # dry run
+
+        old_updated = self.second_customer.updated
+        with self.assertNumQueries(4):  # select and a single bulk update wrapped in a savepoint
+            CustomerSync().run()
+        self.second_customer.refresh_from_db()
+        self.assertEqual(self.second_customer.sources, [{"id": "card_2"}])
+        self.assertEqual(self.second_customer.default_source, "card_2")
+        self.assertGreater(self.second_customer.updated, old_updated)
+        self.assertTrue(self.second_customer.stripe_digest)
+
+        # nothing has changed at Stripe, nothing is written
+        with self.assertNumQueries(1):
+            stats = CustomerSync().run()
+        self.assertEqual(stats["updated"], 0)
+        self.assertEqual(stats["unchanged"], 2)
+
+        # the existing customer will be updated, because sources have been changed
+        stripe_customer = self._get_customer_data("cus_b", [{"id": "card_3"}], default_source="card_3")
+        m.register_uri("GET", "https://api.stripe.com/v1/customers", text=self._get_list_response([stripe_customer]))
+        stats = CustomerSync().run()
+        self.assertEqual(stats["updated"], 1)
+        self.second_customer.refresh_from_db()
+        self.assertEqual(self.second_customer.default_source, "card_3")
+
+    @requests_mock.Mocker()
+    def test_checkpoint(self, m):
+        m.register_uri("GET", "https://api.stripe.com/v1/customers", text=self._get_list_response(
+            [self._get_customer_data("cus_a", [])], has_more=True))
+        m.register_uri("GET", "https://api.stripe.com/v1/customers?starting_after=cus_a", text="", status_code=500)
+        sync = CustomerSync()
+        sync.max_retries = 0
+        with self.assertRaises(Exception):
+            sync.run()
+        self.assertEqual(sync.checkpoint, "cus_a")
+
+        m.register_uri("GET", "https://api.stripe.com/v1/customers?starting_after=cus_a", text=self._get_list_response(
+            [self._get_customer_data("cus_b", [{"id": "card_2"}])]))
+        stats = CustomerSync(starting_after=sync.checkpoint).run()
+        self.assertEqual(stats["fetched"], 1)
+        self.assertEqual(stats["updated"], 1)
+
+    @requests_mock.Mocker()
+    def test_refresh_commands(self, m):
+        plan = StripeSubscriptionPlan.objects.create(
+            amount=100, name="plan", interval=StripeSubscriptionPlan.INTERVAL_MONTH)
+        subscription = StripeSubscription.objects.create(
+            user=self.user, customer=self.customer, plan=plan, stripe_subscription_id="sub_a",
+            status=StripeSubscription.STATUS_ACTIVE, is_created_at_stripe=True)
+        charge = StripeCharge.objects.create(
+            user=self.user, customer=self.customer, amount=100, stripe_charge_id="ch_a", is_charged=True)
+
+        m.register_uri("GET", "https://api.stripe.com/v1/plans", text=self._get_list_response([
+            {"id": str(plan.id), "object": "plan", "amount": 200, "currency": "usd", "interval": "month",
+             "interval_count": 1, "name": "new name", "metadata": {}, "statement_descriptor": None,
+             "trial_period_days": None},
+            {"id": "dashboard-plan", "object": "plan"},
+        ]))
+        m.register_uri("GET", "https://api.stripe.com/v1/subscriptions", text=self._get_list_response([
+            {"id": "sub_a", "object": "subscription", "status": "past_due"},
+        ]))
+        m.register_uri("GET", "https://api.stripe.com/v1/charges", text=self._get_list_response([
+            {"id": "ch_a", "object": "charge", "paid": True, "amount_refunded": 100, "refunded": True},
+        ]))
+        call_command("refresh_plans")
+        call_command("refresh_subscriptions")
+        call_command("refresh_charges", dry_run=True)
+
+        plan.refresh_from_db()
+        self.assertTrue(plan.is_created_at_stripe)
+        self.assertEqual(plan.amount, 200)
+        self.assertEqual(plan.name, "new name")
+        self.assertEqual(plan.currency, "USD")
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_PAST_DUE)
+        self.assertEqual(subscription.stripe_response["id"], "sub_a")
+        charge.refresh_from_db()
+        self.assertFalse(charge.is_refunded)  # dry run
+
+        stats = ChargeSync().run()
+        self.assertEqual(stats["updated"], 1)
+        charge.refresh_from_db()
+        self.assertTrue(charge.is_refunded)
+        self.assertEqual(charge.amount_refunded, 100)
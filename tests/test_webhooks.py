@@ -14,8 +14,9 @@ from rest_framework.reverse import reverse
 
 from aa_stripe.exceptions import StripeWebhookAlreadyParsed
 from aa_stripe.management.commands.check_pending_webhooks import StripePendingWebooksLimitExceeded
-from aa_stripe.models import StripeCoupon, StripeWebhook
+from aa_stripe.models import StripeCoupon, StripeSubscription, StripeSubscriptionPlan, StripeWebhook
 from aa_stripe.settings import stripe_settings
+from aa_stripe.utils import timestamp_to_timezone_aware_date
 from tests.test_utils import BaseTestCase
 
 
@@ -315,8 +316,8 @@ class TestWebhook(BaseTestCase):
               },
               "percent_off": null,
               "redeem_by": null,
-              "times_redeemed": 0,
-              "valid": true
+              "times_redeemed": 5,
+              "valid": false
             },
             "previous_attributes": {
               "metadata": {
@@ -343,6 +344,22 @@ class TestWebhook(BaseTestCase):
         coupon.refresh_from_db()
         self.assertEqual(response.status_code, 201)
         self.assertEqual(coupon.metadata, {"lol1": "rotfl2", "lol2": "yeah"})
+        self.assertEqual(coupon.times_redeemed, 5)
+        self.assertFalse(coupon.valid)
+        self.assertEqual(coupon.duration, StripeCoupon.DURATION_FOREVER)
+
+        # the coupon has the digest of the webhook data, so it is skipped by refresh_coupons and has to stay up to date
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                "GET",
+                "https://api.stripe.com/v1/coupons",
+                text=json.dumps({"object": "list", "has_more": False, "data": [payload["data"]["object"]]}),
+            )
+            call_command("refresh_coupons")
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.times_redeemed, 5)
+        self.assertFalse(coupon.valid)
+        self.assertFalse(coupon.is_redeemable())
 
         # test updating non existing coupon - nothing else than saving the webhook should happen
         payload["id"] = "evt_1"
@@ -658,3 +675,58 @@ class TestWebhook(BaseTestCase):
             self.assertEqual(response.status_code, 201)
             self.customer.refresh_from_db()
             self.assertEqual(self.customer.sources, [])
+
+    @requests_mock.Mocker()
+    def test_subscription_update(self, m):
+        self._create_customer()
+        plan = StripeSubscriptionPlan.objects.create(
+            amount=100, name="plan", interval=StripeSubscriptionPlan.INTERVAL_MONTH, is_created_at_stripe=True)
+        subscription = StripeSubscription.objects.create(
+            user=self.user, customer=self.customer, plan=plan, stripe_subscription_id="sub_xyz",
+            status=StripeSubscription.STATUS_ACTIVE, is_created_at_stripe=True)
+
+        def post_event(event_id, event_type, created, data):
+            payload = {
+                "id": event_id,
+                "object": "event",
+                "api_version": "2018-01-01",
+                "created": created,
+                "data": {"object": dict({"id": "sub_xyz", "object": "subscription"}, **data)},
+                "type": event_type,
+            }
+            self.client.credentials(**self._get_signature_headers(payload))
+            response = self.client.post(reverse("stripe-webhooks"), data=payload, format="json")
+            self.assertEqual(response.status_code, 201)
+            subscription.refresh_from_db()
+
+        post_event("evt_1", "customer.subscription.updated", 1503477866, {"status": "past_due"})
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_PAST_DUE)
+        self.assertEqual(subscription.stripe_response["status"], "past_due")
+
+        # older events do not overwrite data from the newer ones
+        post_event("evt_2", "customer.subscription.updated", 1503477800, {"status": "active"})
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_PAST_DUE)
+
+        post_event("evt_3", "customer.subscription.updated", 1503477900, {
+            "status": "active", "cancel_at_period_end": True, "canceled_at": 1503477900})
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+        self.assertTrue(subscription.at_period_end)
+        self.assertIsNotNone(subscription.canceled_at)
+
+        post_event("evt_4", "customer.subscription.deleted", 1503478000, {
+            "status": "canceled", "canceled_at": 1503478000})
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_CANCELED)
+        self.assertFalse(subscription.at_period_end)
+
+        # subscriptions not created with aa-stripe are ignored
+        post_event("evt_5", "customer.subscription.created", 1503478000, {"id": "sub_abc", "status": "active"})
+        self.assertFalse(StripeSubscription.objects.filter(stripe_subscription_id="sub_abc").exists())
+        self.assertFalse(m.called)  # Stripe API is not called
+
+        # events created before the subscription was refreshed from Stripe API do not overwrite the refreshed data
+        m.register_uri("GET", "https://api.stripe.com/v1/subscriptions/sub_xyz", text=json.dumps(
+            {"id": "sub_xyz", "object": "subscription", "status": "past_due"}))
+        subscription.refresh_from_stripe()
+        self.assertGreater(subscription.stripe_event_created, timestamp_to_timezone_aware_date(1503478000))
+        post_event("evt_6", "customer.subscription.updated", 1503479000, {"status": "active"})
+        self.assertEqual(subscription.status, StripeSubscription.STATUS_PAST_DUE)